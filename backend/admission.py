@@ -0,0 +1,161 @@
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request is rejected by admission control."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Service overloaded")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded concurrency plus a bounded wait queue with an adaptive limit.
+
+    At most `limit` requests run at once and at most `max_queue` wait for a
+    slot; anything beyond that is rejected immediately with a Retry-After
+    derived from the observed completion rate. The limit follows an AIMD
+    rule on the latency of the protected call: while latency stays under
+    `target_latency` it grows by roughly one per `limit` completions, and
+    when latency exceeds `target_latency * tolerance` it is multiplied by
+    `backoff` (at most once per `target_latency` seconds).
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_queue: int = 16,
+        queue_timeout: float = 30.0,
+        target_latency: float = 10.0,
+        tolerance: float = 2.0,
+        backoff: float = 0.7,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.tolerance = tolerance
+        self.backoff = backoff
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+        self.latency_ewma = 0.0
+        self.last_decrease = 0.0
+        self.completions: Deque[float] = deque(maxlen=200)
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(self.min_concurrency, int(self.limit))
+
+    def throughput(self) -> float:
+        """Completed requests per second, from recent completions or the latency estimate."""
+        now = time.monotonic()
+        recent = [t for t in self.completions if now - t <= 60]
+        if len(recent) >= 2 and now - recent[0] > 0:
+            return len(recent) / (now - recent[0])
+        if self.latency_ewma > 0:
+            return self.concurrency_limit / self.latency_ewma
+        return 0.0
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is expected to drain."""
+        rate = self.throughput()
+        backlog = self.in_flight + len(self.waiters) + 1
+        if rate <= 0:
+            return max(1, math.ceil(self.target_latency))
+        return max(1, math.ceil(backlog / rate))
+
+    async def acquire(self):
+        if self.in_flight < self.concurrency_limit and not self.waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await asyncio.wait_for(future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise Overloaded(self.retry_after())
+        except asyncio.CancelledError:
+            # A slot may have been handed over just before cancellation
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+        finally:
+            if future in self.waiters:
+                self.waiters.remove(future)
+        self.admitted += 1
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        while self.waiters and self.in_flight < self.concurrency_limit:
+            future = self.waiters.popleft()
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def release(self):
+        self._release_slot()
+
+    def record_latency(self, seconds: float):
+        """Feed the latency of the protected call into the adaptive limit."""
+        now = time.monotonic()
+        self.completions.append(now)
+        if self.latency_ewma == 0:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * seconds
+
+        if self.latency_ewma > self.target_latency * self.tolerance:
+            if now - self.last_decrease >= self.target_latency:
+                self.limit = max(self.min_concurrency, self.limit * self.backoff)
+                self.last_decrease = now
+        elif self.latency_ewma < self.target_latency:
+            self.limit = min(self.max_concurrency, self.limit + 1 / max(self.limit, 1))
+        self._wake_waiters()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency_limit": self.concurrency_limit,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "max_queue": self.max_queue,
+            "latency_ewma_s": round(self.latency_ewma, 3),
+            "throughput_per_s": round(self.throughput(), 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
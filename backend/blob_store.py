@@ -0,0 +1,111 @@
+import io
+import os
+import re
+import logging
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class BlobStore:
+    """Content-addressed image store on local disk.
+
+    Each upload is stored once under its SHA-256 digest, next to a small
+    JPEG thumbnail generated at write time:
+
+        <root>/ab/cd/abcd...ef        original bytes
+        <root>/ab/cd/abcd...ef.jpg    thumbnail
+
+    Files are written to a temporary name and renamed into place, so
+    readers never see partial blobs and concurrent uploads of the same
+    image simply race to an identical result. Uploading an image that is
+    already present costs one stat and no extra storage.
+    """
+
+    def __init__(self, root: str = "blobs", thumbnail_size: int = 256, thumbnail_quality: int = 80):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_quality = thumbnail_quality
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_digest(digest: str) -> bool:
+        return bool(DIGEST_PATTERN.fullmatch(digest or ""))
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def contains(self, digest: str) -> bool:
+        """Whether a complete entry (blob and thumbnail) exists."""
+        return self.is_digest(digest) and os.path.exists(self.blob_path(digest) + ".jpg")
+
+    def thumbnail_path(self, digest: str) -> Optional[str]:
+        """Path of an existing thumbnail, or None for unknown or malformed digests."""
+        if not self.is_digest(digest):
+            return None
+        path = self.blob_path(digest) + ".jpg"
+        return path if os.path.exists(path) else None
+
+    def _write_atomic(self, path: str, data: bytes):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def make_thumbnail(self, image_bytes: bytes) -> bytes:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=self.thumbnail_quality, optimize=True)
+        return output.getvalue()
+
+    def put(self, digest: str, image_bytes: bytes) -> bool:
+        """Store an upload and its thumbnail unless already present; returns True if written."""
+        if not self.is_digest(digest):
+            raise ValueError(f"Invalid blob digest: {digest!r}")
+
+        path = self.blob_path(digest)
+        if os.path.exists(path + ".jpg"):
+            with self._lock:
+                self.deduplicated += 1
+            return False
+
+        try:
+            thumbnail = self.make_thumbnail(image_bytes)
+            self._write_atomic(path, image_bytes)
+            # The thumbnail goes last: its presence marks a complete entry
+            self._write_atomic(path + ".jpg", thumbnail)
+        except Exception as e:
+            logger.warning(f"Could not store image {digest[:12]}: {e}")
+            return False
+
+        with self._lock:
+            self.stored += 1
+            self.bytes_written += len(image_bytes) + len(thumbnail)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "stored": self.stored,
+                "deduplicated": self.deduplicated,
+                "bytes_written": self.bytes_written,
+            }
@@ -0,0 +1,65 @@
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CaptionPool:
+    """Pre-generated captions per image digest, served to regenerate requests.
+
+    One Gemini call asks for a larger set of captions; the first three go to
+    the user and the rest wait here, so uploading the same image again
+    ("Regenerate") is answered without another round trip. Entries expire
+    after `ttl` seconds and the pool keeps at most `max_images` images (LRU).
+    """
+
+    def __init__(self, max_images: int = 1000, ttl: float = 3600):
+        self.max_images = max_images
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, Deque[str]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def put(self, digest: str, captions: List[str]):
+        """Add spare captions for an image."""
+        if not captions or self.max_images <= 0:
+            return
+
+        with self._lock:
+            _, pooled = self.entries.pop(digest, (0, deque()))
+            pooled.extend(caption for caption in captions if caption not in pooled)
+            self.entries[digest] = (time.monotonic() + self.ttl, pooled)
+            while len(self.entries) > self.max_images:
+                self.entries.popitem(last=False)
+
+    def take(self, digest: str, count: int = 3) -> Optional[List[str]]:
+        """Pop `count` captions for an image, or None if the pool cannot cover them."""
+        with self._lock:
+            entry = self.entries.get(digest)
+            if entry is None or entry[0] < time.monotonic() or len(entry[1]) < count:
+                if entry is not None and (entry[0] < time.monotonic() or not entry[1]):
+                    del self.entries[digest]
+                self.misses += 1
+                return None
+
+            pooled = entry[1]
+            captions = [pooled.popleft() for _ in range(count)]
+            if pooled:
+                self.entries.move_to_end(digest)
+            else:
+                del self.entries[digest]
+            self.hits += 1
+            return captions
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "images": len(self.entries),
+                "captions": sum(len(pooled) for _, pooled in self.entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,16 +1,58 @@
+import re
 import sqlite3
 import hashlib
 import secrets
+import json
+from concurrent.futures import Future
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Iterator, Callable
 import logging
 
+from write_behind import WriteBehindQueue
+
 logger = logging.getLogger(__name__)
 
+# Each message owns a block of rowids in message_captions_fts: message_id * CAPTION_SLOTS + position
+CAPTION_SLOTS = 64
+
+SEARCH_KINDS = ("saved_caption", "message", "caption")
+
+# Shorter terms match exactly: the FTS prefix indexes (prefix='2 3') start at two
+# characters, and a one-character prefix query scans the whole term index
+MIN_PREFIX_LENGTH = 2
+
+def conversations_scope(user_id: int) -> str:
+    return f"conversations:{user_id}"
+
+def messages_scope(conversation_id: int) -> str:
+    return f"messages:{conversation_id}"
+
+def saved_captions_scope(user_id: int) -> str:
+    return f"saved:{user_id}"
+
 class Database:
-    def __init__(self, db_path: str = "caption_maker.db"):
+    def __init__(
+        self,
+        db_path: str = "caption_maker.db",
+        write_behind: bool = False,
+        flush_interval: float = 0.05,
+        max_batch: int = 256
+    ):
         self.db_path = db_path
         self.init_database()
+        
+        # Sharded storage hands out globally unique conversation ids (see storage.py)
+        self.conversation_id_allocator: Optional[Callable[[int, int], List[int]]] = None
+        
+        # Optional write-behind queue that batches message inserts into shared transactions
+        self.write_queue = None
+        if write_behind:
+            self.write_queue = WriteBehindQueue(
+                self._write_messages,
+                flush_interval=flush_interval,
+                max_batch=max_batch,
+                name="message-write-behind"
+            )
     
     def get_connection(self):
         """Get database connection."""
@@ -23,6 +65,24 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # WAL lets long-running readers (streamed exports) coexist with writers
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
+        # One transaction for the whole schema: sqlite3 would otherwise autocommit
+        # each ALTER TABLE, and a failed start could keep new columns without their backfill
+        cursor.execute("BEGIN")
+        try:
+            self.create_schema(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        logger.info("Database initialized successfully")
+    
+    def create_schema(self, cursor: sqlite3.Cursor):
+        """Create missing tables, columns and indexes, backfilling derived data."""
         # Users table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -54,6 +114,9 @@ class Database:
                 title TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                last_caption TEXT,
+                thumbnail_digest TEXT,
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
             )
         """)
@@ -82,9 +145,157 @@ class Database:
             )
         """)
         
-        conn.commit()
+        # Version counters per cacheable resource, used as ETags
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS resource_versions (
+                scope TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        
+        # Digest of the uploaded image in the blob store; the summary backfill below reads it
+        self.add_missing_columns(cursor, "messages", {"image_digest": "TEXT"})
+        
+        # Summary columns for databases created before they existed
+        if self.add_missing_columns(cursor, "conversations", {
+            "message_count": "INTEGER NOT NULL DEFAULT 0",
+            "last_caption": "TEXT",
+            "thumbnail_digest": "TEXT",
+        }):
+            self.refresh_conversation_summaries(cursor)
+            logger.info("Conversation summaries backfilled")
+        
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user_id, updated_at DESC)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, created_at)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_image_digest ON messages (image_digest) WHERE image_digest IS NOT NULL"
+        )
+        
+        self.init_search_index(cursor)
+    
+    def add_missing_columns(self, cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> List[str]:
+        """Add columns that an older schema lacks; returns the names added."""
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        
+        added = []
+        for name, definition in columns.items():
+            if name not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                added.append(name)
+        return added
+    
+    def refresh_conversation_summaries(self, cursor: sqlite3.Cursor, conversation_ids: Optional[List[int]] = None):
+        """Recompute message_count, last_caption and thumbnail_digest from the messages table."""
+        query = """
+            UPDATE conversations SET
+                message_count = (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id),
+                last_caption = (
+                    SELECT json_extract(captions, '$[0]') FROM messages
+                    WHERE conversation_id = conversations.id AND captions IS NOT NULL
+                    ORDER BY id DESC LIMIT 1
+                ),
+                thumbnail_digest = COALESCE((
+                    SELECT image_digest FROM messages
+                    WHERE conversation_id = conversations.id AND image_digest IS NOT NULL
+                    ORDER BY id DESC LIMIT 1
+                ), thumbnail_digest)
+        """
+        if conversation_ids is None:
+            cursor.execute(query)
+        else:
+            cursor.executemany(query + " WHERE id = ?", [(conversation_id,) for conversation_id in conversation_ids])
+    
+    def init_search_index(self, cursor: sqlite3.Cursor):
+        """Create FTS5 tables kept in sync with captions and messages by triggers.
+        
+        Every FTS table has the searchable text in `body` and the owning user
+        as an indexed `owner` token ('u<id>'), so per-user queries are resolved
+        by the full-text index rather than by filtering all matches.
+        """
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+        needs_backfill = cursor.fetchone() is None
+        
+        for table in ("saved_captions_fts", "messages_fts", "message_captions_fts"):
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+                    body, owner, prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+                )
+            """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS saved_captions_fts_insert AFTER INSERT ON saved_captions BEGIN
+                INSERT INTO saved_captions_fts (rowid, body, owner)
+                VALUES (new.id, new.caption, 'u' || new.user_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS saved_captions_fts_delete AFTER DELETE ON saved_captions BEGIN
+                DELETE FROM saved_captions_fts WHERE rowid = old.id;
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, body, owner)
+                SELECT new.id, new.content, 'u' || user_id FROM conversations WHERE id = new.conversation_id;
+                INSERT INTO message_captions_fts (rowid, body, owner)
+                SELECT new.id * {CAPTION_SLOTS} + captions.key, captions.value, 'u' || conversations.user_id
+                FROM json_each(COALESCE(new.captions, '[]')) AS captions, conversations
+                WHERE conversations.id = new.conversation_id AND captions.key < {CAPTION_SLOTS};
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                DELETE FROM messages_fts WHERE rowid = old.id;
+                DELETE FROM message_captions_fts
+                WHERE rowid BETWEEN old.id * {CAPTION_SLOTS} AND old.id * {CAPTION_SLOTS} + {CAPTION_SLOTS - 1};
+            END
+        """)
+        
+        if needs_backfill:
+            cursor.execute("""
+                INSERT INTO saved_captions_fts (rowid, body, owner)
+                SELECT id, caption, 'u' || user_id FROM saved_captions
+            """)
+            cursor.execute("""
+                INSERT INTO messages_fts (rowid, body, owner)
+                SELECT m.id, m.content, 'u' || c.user_id
+                FROM messages m JOIN conversations c ON c.id = m.conversation_id
+            """)
+            cursor.execute(f"""
+                INSERT INTO message_captions_fts (rowid, body, owner)
+                SELECT m.id * {CAPTION_SLOTS} + captions.key, captions.value, 'u' || c.user_id
+                FROM messages m
+                JOIN conversations c ON c.id = m.conversation_id,
+                json_each(m.captions) AS captions
+                WHERE m.captions IS NOT NULL AND captions.key < {CAPTION_SLOTS}
+            """)
+            logger.info("Search index backfilled")
+    
+    def bump_versions(self, cursor: sqlite3.Cursor, scopes: List[str]):
+        """Increment the version of each resource scope inside the caller's transaction."""
+        cursor.executemany(
+            """INSERT INTO resource_versions (scope, version) VALUES (?, 1) 
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1""",
+            [(scope,) for scope in scopes]
+        )
+    
+    def get_version(self, scope: str) -> int:
+        """Current version of a resource scope (0 if it was never written)."""
+        self.flush_writes()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT version FROM resource_versions WHERE scope = ?", (scope,))
+        
+        result = cursor.fetchone()
         conn.close()
-        logger.info("Database initialized successfully")
+        
+        return result[0] if result else 0
     
     def hash_password(self, password: str) -> str:
         """Hash password with SHA-256."""
@@ -92,8 +303,8 @@ class Database:
     
     def create_user(self, username: str, email: str, password: str) -> Optional[int]:
         """Create a new user."""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             cursor = conn.cursor()
             
             password_hash = self.hash_password(password)
@@ -104,13 +315,15 @@ class Database:
             user_id = cursor.lastrowid
             
             conn.commit()
-            conn.close()
             
             logger.info(f"User created: {username}")
             return user_id
         except sqlite3.IntegrityError as e:
+            conn.rollback()
             logger.error(f"User creation failed: {e}")
             return None
+        finally:
+            conn.close()
     
     def verify_user(self, username: str, password: str) -> Optional[Dict[str, Any]]:
         """Verify user credentials."""
@@ -174,16 +387,36 @@ class Database:
         conn.commit()
         conn.close()
     
+    def new_conversation_id(self, user_id: int) -> Optional[int]:
+        """Id for a new conversation, or None to let SQLite assign one."""
+        return self.new_conversation_ids(user_id, 1)[0]
+    
+    def new_conversation_ids(self, user_id: int, count: int) -> List[Optional[int]]:
+        """Ids for `count` new conversations, reserved in one round trip."""
+        if self.conversation_id_allocator and count:
+            return self.conversation_id_allocator(user_id, count)
+        return [None] * count
+    
+    def conversation_owner(self, conversation_id: int) -> Optional[int]:
+        """User id owning a conversation, or None if it does not exist."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM conversations WHERE id = ?", (conversation_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0] if result else None
+    
     def create_conversation(self, user_id: int, title: str = "New Conversation") -> int:
         """Create a new conversation."""
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute(
-            "INSERT INTO conversations (user_id, title) VALUES (?, ?)",
-            (user_id, title)
+            "INSERT INTO conversations (id, user_id, title) VALUES (?, ?, ?)",
+            (self.new_conversation_id(user_id), user_id, title)
         )
         conversation_id = cursor.lastrowid
+        self.bump_versions(cursor, [conversations_scope(user_id)])
         
         conn.commit()
         conn.close()
@@ -191,12 +424,14 @@ class Database:
         return conversation_id
     
     def get_user_conversations(self, user_id: int) -> List[Dict[str, Any]]:
-        """Get all conversations for a user."""
+        """Get all conversations for a user with their preview summaries."""
+        self.flush_writes()
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute(
-            """SELECT id, title, created_at, updated_at 
+            """SELECT id, title, created_at, updated_at, message_count, last_caption, 
+                      thumbnail_digest, updated_at AS last_activity 
                FROM conversations 
                WHERE user_id = ? 
                ORDER BY updated_at DESC""",
@@ -213,41 +448,114 @@ class Database:
         conversation_id: int, 
         role: str, 
         content: str, 
-        captions: Optional[List[str]] = None
+        captions: Optional[List[str]] = None,
+        image_digest: Optional[str] = None
     ) -> int:
         """Add a message to a conversation."""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        return self.enqueue_message(conversation_id, role, content, captions, image_digest).result()
+    
+    def enqueue_message(
+        self,
+        conversation_id: int,
+        role: str,
+        content: str,
+        captions: Optional[List[str]] = None,
+        image_digest: Optional[str] = None
+    ) -> Future:
+        """Add a message, returning a Future for its id.
+        
+        With write-behind enabled the insert joins the next batched transaction;
+        otherwise it is written immediately and the Future is already resolved.
+        """
         # Convert captions list to JSON string
-        import json
         captions_json = json.dumps(captions) if captions else None
+        last_caption = captions[0] if captions else None
+        row = (conversation_id, role, content, captions_json, last_caption, image_digest)
         
-        cursor.execute(
-            """INSERT INTO messages (conversation_id, role, content, captions) 
-               VALUES (?, ?, ?, ?)""",
-            (conversation_id, role, content, captions_json)
-        )
-        message_id = cursor.lastrowid
+        if self.write_queue:
+            return self.write_queue.submit(row)
         
-        # Update conversation timestamp
-        cursor.execute(
-            "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (conversation_id,)
-        )
+        future = Future()
+        future.set_result(self._write_messages([row])[0])
+        return future
+    
+    def _write_messages(self, rows: List[Tuple[int, str, str, Optional[str], Optional[str], Optional[str]]]) -> List[int]:
+        """Insert messages and update their conversation summaries in one transaction.
         
-        conn.commit()
-        conn.close()
+        Rolls back on failure, so the write queue can safely retry the batch.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
-        return message_id
+        try:
+            message_ids = []
+            summaries = {}
+            for conversation_id, role, content, captions_json, last_caption, image_digest in rows:
+                cursor.execute(
+                    """INSERT INTO messages (conversation_id, role, content, captions, image_digest) 
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (conversation_id, role, content, captions_json, image_digest)
+                )
+                message_ids.append(cursor.lastrowid)
+                
+                count, caption, digest = summaries.get(conversation_id, (0, None, None))
+                summaries[conversation_id] = (count + 1, last_caption or caption, image_digest or digest)
+            
+            # Update each conversation's summary and timestamp once per batch
+            cursor.executemany(
+                """UPDATE conversations SET 
+                       message_count = message_count + ?, 
+                       last_caption = COALESCE(?, last_caption), 
+                       thumbnail_digest = COALESCE(?, thumbnail_digest), 
+                       updated_at = CURRENT_TIMESTAMP 
+                   WHERE id = ?""",
+                [(count, caption, digest, conversation_id) for conversation_id, (count, caption, digest) in summaries.items()]
+            )
+            
+            placeholders = ", ".join("?" * len(summaries))
+            cursor.execute(
+                f"SELECT DISTINCT user_id FROM conversations WHERE id IN ({placeholders})",
+                list(summaries)
+            )
+            self.bump_versions(
+                cursor,
+                [messages_scope(conversation_id) for conversation_id in summaries] +
+                [conversations_scope(row[0]) for row in cursor.fetchall()]
+            )
+            
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        return message_ids
+    
+    def flush_writes(self):
+        """Read barrier: make queued writes visible before reading."""
+        if self.write_queue:
+            self.write_queue.flush()
+    
+    def close(self):
+        """Flush and stop background writers."""
+        if self.write_queue:
+            self.write_queue.close()
+    
+    def write_stats(self) -> Optional[Dict[str, Any]]:
+        """Batch size and flush latency metrics for the write-behind queue."""
+        if self.write_queue:
+            return self.write_queue.stats()
+        return None
     
     def get_conversation_messages(self, conversation_id: int) -> List[Dict[str, Any]]:
         """Get all messages in a conversation."""
+        self.flush_writes()
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute(
-            """SELECT id, role, content, captions, created_at 
+            """SELECT id, role, content, captions, image_digest, created_at 
                FROM messages 
                WHERE conversation_id = ? 
                ORDER BY created_at ASC""",
@@ -258,7 +566,6 @@ class Database:
         for row in cursor.fetchall():
             msg = dict(row)
             # Parse captions JSON
-            import json
             if msg['captions']:
                 msg['captions'] = json.loads(msg['captions'])
             messages.append(msg)
@@ -266,6 +573,20 @@ class Database:
         conn.close()
         return messages
     
+    def user_has_image(self, user_id: int, image_digest: str) -> bool:
+        """Whether any of the user's messages references an uploaded image."""
+        self.flush_writes()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT 1 FROM messages m JOIN conversations c ON c.id = m.conversation_id
+               WHERE m.image_digest = ? AND c.user_id = ? LIMIT 1""",
+            (image_digest, user_id)
+        )
+        result = cursor.fetchone()
+        conn.close()
+        return result is not None
+    
     def save_caption(self, user_id: int, caption: str) -> int:
         """Save a caption for a user."""
         conn = self.get_connection()
@@ -276,6 +597,7 @@ class Database:
             (user_id, caption)
         )
         caption_id = cursor.lastrowid
+        self.bump_versions(cursor, [saved_captions_scope(user_id)])
         
         conn.commit()
         conn.close()
@@ -311,6 +633,8 @@ class Database:
         )
         
         deleted = cursor.rowcount > 0
+        if deleted:
+            self.bump_versions(cursor, [saved_captions_scope(user_id)])
         conn.commit()
         conn.close()
         
@@ -332,3 +656,224 @@ class Database:
         if user:
             return dict(user)
         return None
+    
+    def build_search_query(self, user_id: int, query: str, prefix: bool = True) -> Optional[str]:
+        """Turn free text into an FTS5 expression scoped to one user."""
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return None
+        body = " ".join(
+            f'"{term}"*' if prefix and len(term) >= MIN_PREFIX_LENGTH else f'"{term}"'
+            for term in terms
+        )
+        return f'owner:"u{user_id}" AND body:({body})'
+    
+    def search(
+        self,
+        user_id: int,
+        query: str,
+        limit: int = 20,
+        offset: int = 0,
+        kinds: Optional[List[str]] = None,
+        prefix: bool = True
+    ) -> List[Dict[str, Any]]:
+        """Ranked full-text search over saved captions, messages and generated captions."""
+        match = self.build_search_query(user_id, query, prefix)
+        if not match:
+            return []
+        kinds = kinds or list(SEARCH_KINDS)
+        
+        selects = {
+            "saved_caption": """
+                SELECT 'saved_caption' AS kind, s.id AS id, NULL AS conversation_id, NULL AS position,
+                       s.caption AS text, snippet(saved_captions_fts, 0, '[', ']', '…', 12) AS highlight,
+                       s.created_at AS created_at, bm25(saved_captions_fts, 1.0, 0.0) AS score
+                FROM saved_captions_fts JOIN saved_captions s ON s.id = saved_captions_fts.rowid
+                WHERE saved_captions_fts MATCH ?""",
+            "message": """
+                SELECT 'message' AS kind, m.id AS id, m.conversation_id AS conversation_id, NULL AS position,
+                       m.content AS text, snippet(messages_fts, 0, '[', ']', '…', 12) AS highlight,
+                       m.created_at AS created_at, bm25(messages_fts, 1.0, 0.0) AS score
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?""",
+            "caption": f"""
+                SELECT 'caption' AS kind, m.id AS id, m.conversation_id AS conversation_id,
+                       message_captions_fts.rowid % {CAPTION_SLOTS} AS position,
+                       message_captions_fts.body AS text,
+                       snippet(message_captions_fts, 0, '[', ']', '…', 12) AS highlight,
+                       m.created_at AS created_at, bm25(message_captions_fts, 1.0, 0.0) AS score
+                FROM message_captions_fts JOIN messages m ON m.id = message_captions_fts.rowid / {CAPTION_SLOTS}
+                WHERE message_captions_fts MATCH ?""",
+        }
+        parts = [selects[kind] for kind in kinds if kind in selects]
+        if not parts:
+            return []
+        
+        self.flush_writes()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            " UNION ALL ".join(parts) + " ORDER BY score LIMIT ? OFFSET ?",
+            [match] * len(parts) + [limit, offset]
+        )
+        
+        results = [dict(row) for row in cursor.fetchall()]
+        conn.close()
+        
+        return results
+    
+    def export_user_data(self, user_id: int, batch_size: int = 500) -> Iterator[str]:
+        """Yield a user's conversations, messages and saved captions as NDJSON lines.
+        
+        Rows are pulled from one read transaction with fetchmany, so memory
+        stays bounded and the export is a consistent snapshot. Stored caption
+        JSON is spliced into the output as-is instead of being re-parsed.
+        """
+        self.flush_writes()
+        # The generator may be resumed from different threadpool workers
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("BEGIN")
+            yield json.dumps({"type": "export", "version": 1, "user_id": user_id}) + "\n"
+            
+            cursor.execute(
+                """SELECT id, title, created_at, updated_at 
+                   FROM conversations 
+                   WHERE user_id = ? 
+                   ORDER BY id""",
+                (user_id,)
+            )
+            for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+                yield "".join(
+                    json.dumps({
+                        "type": "conversation",
+                        "id": row[0],
+                        "title": row[1],
+                        "created_at": row[2],
+                        "updated_at": row[3]
+                    }, ensure_ascii=False) + "\n"
+                    for row in rows
+                )
+            
+            cursor.execute(
+                """SELECT m.id, m.conversation_id, m.role, m.content, m.captions, m.created_at, m.image_digest 
+                   FROM messages m JOIN conversations c ON c.id = m.conversation_id 
+                   WHERE c.user_id = ? 
+                   ORDER BY m.conversation_id, m.id""",
+                (user_id,)
+            )
+            for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+                yield "".join(
+                    json.dumps({
+                        "type": "message",
+                        "id": row[0],
+                        "conversation_id": row[1],
+                        "role": row[2],
+                        "content": row[3],
+                        "image_digest": row[6],
+                        "created_at": row[5]
+                    }, ensure_ascii=False)[:-1] + ', "captions": ' + (row[4] or "null") + "}\n"
+                    for row in rows
+                )
+            
+            cursor.execute(
+                """SELECT id, caption, created_at 
+                   FROM saved_captions 
+                   WHERE user_id = ? 
+                   ORDER BY id""",
+                (user_id,)
+            )
+            for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+                yield "".join(
+                    json.dumps({
+                        "type": "saved_caption",
+                        "id": row[0],
+                        "caption": row[1],
+                        "created_at": row[2]
+                    }, ensure_ascii=False) + "\n"
+                    for row in rows
+                )
+        finally:
+            conn.rollback()
+            conn.close()
+    
+    def import_records(
+        self,
+        user_id: int,
+        records: List[Dict[str, Any]],
+        conversation_ids: Dict[int, int]
+    ) -> Dict[str, int]:
+        """Import one chunk of exported records for a user in a single transaction.
+        
+        `conversation_ids` maps exported conversation ids to the new ones and is
+        updated in place, so it must be shared across the chunks of one import.
+        Conversations have to appear before their messages, as in an export.
+        """
+        counts = {"conversations": 0, "messages": 0, "saved_captions": 0, "skipped": 0}
+        messages = []
+        saved_captions = []
+        
+        new_ids = iter(self.new_conversation_ids(user_id, sum(
+            1 for record in records
+            if isinstance(record, dict) and record.get("type") == "conversation"
+            and isinstance(record.get("id"), (int, str))
+        )))
+        
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        for record in records:
+            record_type = record.get("type") if isinstance(record, dict) else None
+            if record_type == "conversation" and isinstance(record.get("id"), (int, str)):
+                cursor.execute(
+                    """INSERT INTO conversations (id, user_id, title, created_at, updated_at) 
+                       VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))""",
+                    (next(new_ids), user_id, record.get("title"),
+                     record.get("created_at"), record.get("updated_at"))
+                )
+                conversation_ids[record["id"]] = cursor.lastrowid
+                counts["conversations"] += 1
+            elif record_type == "message" and isinstance(record.get("conversation_id"), (int, str)) \
+                    and record["conversation_id"] in conversation_ids:
+                captions = record.get("captions")
+                messages.append((
+                    conversation_ids[record["conversation_id"]],
+                    record.get("role", "bot"),
+                    record.get("content", ""),
+                    json.dumps(captions) if captions else None,
+                    record.get("image_digest"),
+                    record.get("created_at")
+                ))
+            elif record_type == "saved_caption" and record.get("caption"):
+                saved_captions.append((user_id, record["caption"], record.get("created_at")))
+            elif record_type != "export":
+                counts["skipped"] += 1
+        
+        cursor.executemany(
+            """INSERT INTO messages (conversation_id, role, content, captions, image_digest, created_at) 
+               VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))""",
+            messages
+        )
+        cursor.executemany(
+            """INSERT INTO saved_captions (user_id, caption, created_at) 
+               VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))""",
+            saved_captions
+        )
+        counts["messages"] = len(messages)
+        counts["saved_captions"] = len(saved_captions)
+        
+        if messages:
+            self.refresh_conversation_summaries(cursor, sorted({message[0] for message in messages}))
+        self.bump_versions(
+            cursor,
+            [conversations_scope(user_id), saved_captions_scope(user_id)] +
+            [messages_scope(conversation_id) for conversation_id in {message[0] for message in messages}]
+        )
+        
+        conn.commit()
+        conn.close()
+        
+        return counts
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from typing import Any, Dict, Iterator, Optional
+
+from prompt_templates import IMAGE_TOKENS, estimate_tokens, match_template, parse_json_captions
+
+logger = logging.getLogger(__name__)
+
+
+class CassetteStore:
+    """Compact local store of recorded Gemini interactions.
+
+    Prompts are stored once and referenced by hash; raw response texts are
+    zlib-compressed. Each interaction keeps the image digest, model, number
+    of captions requested and the observed latency, which is enough to
+    replay traffic offline with its original timing.
+    """
+
+    def __init__(self, path: str = "gemini_cassettes.db"):
+        self.path = path
+        self._prompt_ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.lookups = {"exact": 0, "digest_only": 0, "missed": 0}
+        self.init_store()
+
+    def get_connection(self):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def init_store(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS prompts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hash TEXT UNIQUE NOT NULL,
+                text TEXT NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS interactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_digest TEXT NOT NULL,
+                prompt_id INTEGER NOT NULL,
+                model TEXT,
+                caption_count INTEGER NOT NULL DEFAULT 3,
+                response BLOB,
+                latency REAL NOT NULL,
+                recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (prompt_id) REFERENCES prompts(id)
+            )
+        """)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_interactions_lookup ON interactions (image_digest, prompt_id)"
+        )
+
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def prompt_hash(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def _prompt_id(self, cursor: sqlite3.Cursor, prompt: str, create: bool) -> Optional[int]:
+        digest = self.prompt_hash(prompt)
+        if digest in self._prompt_ids:
+            return self._prompt_ids[digest]
+
+        if create:
+            cursor.execute("INSERT OR IGNORE INTO prompts (hash, text) VALUES (?, ?)", (digest, prompt))
+        cursor.execute("SELECT id FROM prompts WHERE hash = ?", (digest,))
+        result = cursor.fetchone()
+        if result:
+            self._prompt_ids[digest] = result[0]
+            return result[0]
+        return None
+
+    def record(
+        self,
+        image_digest: str,
+        prompt: str,
+        model: Optional[str],
+        response: Optional[str],
+        latency: float,
+        caption_count: int = 3
+    ):
+        """Append one interaction."""
+        with self._lock:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+
+            prompt_id = self._prompt_id(cursor, prompt, create=True)
+            cursor.execute(
+                """INSERT INTO interactions (image_digest, prompt_id, model, caption_count, response, latency)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (
+                    image_digest, prompt_id, model, caption_count,
+                    zlib.compress(response.encode("utf-8")) if response is not None else None,
+                    latency
+                )
+            )
+
+            conn.commit()
+            conn.close()
+
+    def _decode(self, row: sqlite3.Row) -> Dict[str, Any]:
+        record = dict(row)
+        if record["response"] is not None:
+            record["response"] = zlib.decompress(record["response"]).decode("utf-8")
+        return record
+
+    def lookup(self, image_digest: str, prompt: str, output: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Latest recording for an image/prompt pair.
+
+        Builds with a different prompt template or caption count still get
+        the latest recording for the image whose template has the same
+        `output` format ("lines" or "json"), so the reply suits their parser;
+        those lookups are counted as `digest_only` in `stats()`.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        prompt_id = self._prompt_id(cursor, prompt, create=False)
+        result = None
+        if prompt_id is not None:
+            cursor.execute(
+                """SELECT image_digest, model, caption_count, response, latency
+                   FROM interactions
+                   WHERE image_digest = ? AND prompt_id = ?
+                   ORDER BY id DESC LIMIT 1""",
+                (image_digest, prompt_id)
+            )
+            result = cursor.fetchone()
+        outcome = "exact"
+
+        if result is None:
+            cursor.execute(
+                """SELECT i.image_digest, i.model, i.caption_count, i.response, i.latency, p.text AS prompt
+                   FROM interactions i JOIN prompts p ON p.id = i.prompt_id
+                   WHERE i.image_digest = ?
+                   ORDER BY i.id DESC""",
+                (image_digest,)
+            )
+            for row in cursor.fetchall():
+                template = match_template(row["prompt"], row["caption_count"])
+                if output is None or (template.output if template else "lines") == output:
+                    result = row
+                    break
+            outcome = "digest_only" if result else "missed"
+
+        conn.close()
+        with self._lock:
+            self.lookups[outcome] += 1
+        if result is None:
+            return None
+        record = self._decode(result)
+        record.pop("prompt", None)
+        return record
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = dict(self.lookups)
+        total = sum(lookups.values())
+        return {
+            "lookups": lookups,
+            "miss_rate": round(lookups["missed"] / total, 4) if total else 0,
+        }
+
+    def iter_interactions(self) -> Iterator[Dict[str, Any]]:
+        """All recordings in the order they were captured."""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            """SELECT i.id, i.image_digest, p.text AS prompt, i.model, i.caption_count, i.response, i.latency
+               FROM interactions i JOIN prompts p ON p.id = i.prompt_id
+               ORDER BY i.id"""
+        )
+        try:
+            for rows in iter(lambda: cursor.fetchmany(500), []):
+                for row in rows:
+                    yield self._decode(row)
+        finally:
+            conn.close()
+
+
+def replay_delay(latency: float, speed: float) -> float:
+    """Delay to apply for a recorded latency; speed 0 replays without waiting."""
+    if speed <= 0:
+        return 0.0
+    return latency / speed
+
+
+def benchmark(store: CassetteStore, generator, speed: float = 0.0) -> Dict[str, Any]:
+    """Replay every recording through the generator's parser and summarise the outcome.
+
+    Run it against two builds on the same cassette to compare parsing
+    results and throughput without calling Gemini. Recordings are grouped
+    by the prompt template that produced them, and the template with the
+    best parse success rate (then fewest padded replies, then lowest
+    latency) is reported as `recommended`.
+    """
+    summary = {
+        "interactions": 0,
+        "parsed": 0,
+        "failed": 0,
+        "padded": 0,
+        "captions": 0,
+        "recorded_latency_s": 0.0,
+        "parse_ms": 0.0,
+    }
+    templates: Dict[str, Dict[str, Any]] = {}
+    started = time.perf_counter()
+
+    for record in store.iter_interactions():
+        template = match_template(record["prompt"], record["caption_count"])
+        entry = templates.setdefault(template.key if template else "unknown", {
+            "interactions": 0, "parsed": 0, "padded": 0,
+            "latency_s": 0.0, "input_tokens": 0, "output_tokens": 0,
+        })
+        summary["interactions"] += 1
+        summary["recorded_latency_s"] += record["latency"]
+        entry["interactions"] += 1
+        entry["latency_s"] += record["latency"]
+        entry["input_tokens"] += estimate_tokens(record["prompt"]) + IMAGE_TOKENS
+        entry["output_tokens"] += estimate_tokens(record["response"])
+        time.sleep(replay_delay(record["latency"], speed))
+
+        if record["response"] is None:
+            summary["failed"] += 1
+            continue
+
+        parse_started = time.perf_counter()
+        captions = generator.parse_gemini_response(
+            record["response"], limit=record["caption_count"],
+            output=template.output if template else "lines"
+        )
+        summary["parse_ms"] += (time.perf_counter() - parse_started) * 1000
+
+        if not captions:
+            summary["failed"] += 1
+            continue
+        summary["parsed"] += 1
+        summary["captions"] += len(captions)
+        entry["parsed"] += 1
+        # Variations and fallbacks fill in when fewer than three usable captions came back
+        lines = parse_json_captions(record["response"]) if template and template.output == "json" else None
+        if lines is None:
+            lines = [line.strip() for line in record["response"].split("\n") if line.strip()]
+        usable = {generator.clean_caption_line(line) for line in lines}
+        if sum(1 for caption in usable if generator.is_valid_caption(caption)) < 3:
+            summary["padded"] += 1
+            entry["padded"] += 1
+
+    elapsed = time.perf_counter() - started
+    summary["wall_time_s"] = round(elapsed, 3)
+    summary["replays_per_s"] = round(summary["interactions"] / elapsed, 1) if elapsed > 0 else 0
+    summary["parse_success_rate"] = round(summary["parsed"] / summary["interactions"], 4) if summary["interactions"] else 0
+    summary["recorded_latency_s"] = round(summary["recorded_latency_s"], 3)
+    summary["parse_ms"] = round(summary["parse_ms"], 3)
+
+    summary["templates"] = {
+        key: {
+            "interactions": entry["interactions"],
+            "parse_success_rate": round(entry["parsed"] / entry["interactions"], 4),
+            "padded": entry["padded"],
+            "avg_latency_s": round(entry["latency_s"] / entry["interactions"], 3),
+            "avg_input_tokens": round(entry["input_tokens"] / entry["interactions"], 1),
+            "avg_output_tokens": round(entry["output_tokens"] / entry["interactions"], 1),
+        }
+        for key, entry in templates.items()
+    }
+    ranked = sorted(
+        (key for key in summary["templates"] if key != "unknown"),
+        key=lambda key: (
+            -summary["templates"][key]["parse_success_rate"],
+            summary["templates"][key]["padded"] / summary["templates"][key]["interactions"],
+            summary["templates"][key]["avg_latency_s"]
+        )
+    )
+    summary["recommended"] = ranked[0] if ranked else None
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="Inspect and replay recorded Gemini traffic")
+    parser.add_argument("command", choices=["stats", "bench"])
+    parser.add_argument("--cassette", default=os.environ.get("GEMINI_CASSETTE_PATH", "gemini_cassettes.db"))
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="Replay speed-up factor; 1 keeps the recorded timing, 0 replays instantly")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cassette):
+        sys.exit(f"Cassette not found: {args.cassette}")
+    store = CassetteStore(args.cassette)
+
+    if args.command == "stats":
+        conn = store.get_connection()
+        row = conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT image_digest), AVG(latency), MAX(latency) FROM interactions"
+        ).fetchone()
+        prompts = conn.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+        conn.close()
+        print(json.dumps({
+            "interactions": row[0],
+            "images": row[1],
+            "prompts": prompts,
+            "avg_latency_s": round(row[2] or 0, 3),
+            "max_latency_s": round(row[3] or 0, 3),
+        }, indent=2))
+    else:
+        from main import gemini_generator
+        print(json.dumps(benchmark(store, gemini_generator, speed=args.speed), indent=2))
@@ -0,0 +1,90 @@
+import gzip
+import logging
+from typing import Any, Callable, Optional
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+    logger.warning("orjson not installed - using standard JSON encoding. Run: pip install orjson")
+
+# Clients may keep a copy but must revalidate it with If-None-Match before use
+CACHE_CONTROL = "private, no-cache"
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson when it is available."""
+
+    def render(self, content: Any) -> bytes:
+        if HAS_ORJSON:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
+
+
+def make_etag(scope: str, version: int) -> str:
+    """Strong ETag for a versioned resource scope."""
+    return f'"{scope.replace(":", "-")}-v{version}"'
+
+
+def gzip_etag(etag: str) -> str:
+    """ETag of the gzip-encoded representation; strong tags must differ per encoding."""
+    return f'{etag[:-1]}-gz"'
+
+
+def accepts_gzip(request: Request) -> bool:
+    return "gzip" in request.headers.get("accept-encoding", "").lower()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (weak comparison, as RFC 9110 requires for it)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+async def conditional_json_response(
+    request: Request,
+    etag: str,
+    build: Callable[[], Any],
+    gzip_min_size: int = 1024,
+    gzip_level: int = 5
+) -> Response:
+    """Return 304 if the client already holds `etag`, otherwise the payload from `build`.
+
+    The version behind `etag` must be read before `build` runs, so a concurrent
+    write can only make the body newer than its tag, never older.
+
+    Bodies of at least `gzip_min_size` bytes are gzip-compressed for clients
+    that accept it and tagged with `gzip_etag(etag)`. Building, encoding and
+    compressing run in the threadpool.
+    """
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if_none_match = request.headers.get("if-none-match")
+    for tag in (etag, gzip_etag(etag)):
+        if etag_matches(if_none_match, tag):
+            headers["ETag"] = tag
+            return Response(status_code=304, headers=headers)
+
+    use_gzip = gzip_level > 0 and accepts_gzip(request)
+
+    def encode():
+        body = FastJSONResponse(build()).body
+        if use_gzip and len(body) >= gzip_min_size:
+            return gzip.compress(body, compresslevel=gzip_level, mtime=0), True
+        return body, False
+
+    body, compressed = await run_in_threadpool(encode)
+    if compressed:
+        headers["ETag"] = gzip_etag(etag)
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
@@ -2,17 +2,32 @@ from __future__ import annotations
 
 import os
 import re
+import json
+import hashlib
+import secrets
 import time
+import asyncio
 import logging
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from PIL import Image
 import io
 
-from fastapi import FastAPI, File, HTTPException, UploadFile, Header, Depends
+from fastapi import FastAPI, File, HTTPException, UploadFile, Header, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from database import Database
+from database import SEARCH_KINDS, conversations_scope, messages_scope, saved_captions_scope
+from storage import create_storage
+from http_cache import conditional_json_response, make_etag
+from scheduler import FairQueueScheduler, SchedulerQueueFull
+from admission import AdmissionController, Overloaded
+from caption_pool import CaptionPool
+from profiling import RequestProfiler, profile_for
+from similarity_index import CaptionSimilarityIndex, extract_features
+from gemini_cassette import CassetteStore, replay_delay
+from blob_store import BlobStore
+from prompt_templates import IMAGE_TOKENS, TokenUsage, estimate_tokens, get_template, parse_json_captions
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -35,6 +50,28 @@ except ImportError:
 
 APP_NAME = "smart-caption-generator-backend"
 
+# Captions requested per Gemini call; extras feed the regenerate pool
+CAPTION_POOL_SIZE = int(os.environ.get("CAPTION_POOL_SIZE", "12"))
+
+# History JSON bodies at least this large are gzip-compressed (level 0 disables it)
+GZIP_MIN_SIZE = int(os.environ.get("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "5"))
+
+# Largest accepted image upload
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+# Records per transaction when importing NDJSON
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", "1000"))
+
+# Id fields an import record of each type must carry, and optional text fields
+IMPORT_ID_KEYS = {"conversation": ("id",), "message": ("conversation_id",)}
+IMPORT_TEXT_KEYS = ("title", "role", "content", "caption", "image_digest", "created_at", "updated_at")
+
+# Caption line cleanup, compiled once
+CAPTION_NUMBERING = re.compile(r'^\d+[\.\)]\s*')
+CAPTION_BULLET = re.compile(r'^[•\-*]\s*')
+CAPTION_QUOTES = re.compile(r'^["\']|["\']$')
+
 class GeminiFreeCaptionGenerator:
     def __init__(self):
         self.api_key = None
@@ -42,9 +79,27 @@ class GeminiFreeCaptionGenerator:
         self.initialized = False
         self.last_request_time = 0
         self.request_delay = 2
+        self.model_name = None
+        self.template = get_template(os.environ.get("PROMPT_TEMPLATE", "").strip())
+        self.token_usage = TokenUsage()
+        # Record-and-replay of Gemini traffic (GEMINI_CASSETTE_MODE=record|replay)
+        self.cassette_mode = os.environ.get("GEMINI_CASSETTE_MODE", "").strip().lower() or None
+        self.replay_speed = float(os.environ.get("GEMINI_REPLAY_SPEED", "1"))
+        self.cassette = None
+        if self.cassette_mode in ("record", "replay"):
+            self.cassette = CassetteStore(os.environ.get("GEMINI_CASSETTE_PATH", "gemini_cassettes.db"))
+        elif self.cassette_mode:
+            logger.warning(f"Unknown GEMINI_CASSETTE_MODE: {self.cassette_mode}")
+            self.cassette_mode = None
         
     def initialize(self) -> bool:
         """Initialize Gemini with correct model names."""
+        if self.cassette_mode == "replay":
+            logger.info(f"Replaying Gemini traffic from {self.cassette.path} (speed {self.replay_speed}x)")
+            self.model_name = "replay"
+            self.initialized = True
+            return True
+        
         if not HAS_GEMINI:
             logger.error("Gemini library not available")
             return False
@@ -96,6 +151,7 @@ class GeminiFreeCaptionGenerator:
                     test_response = self.model.generate_content("Say 'OK'")
                     if test_response and test_response.text:
                         logger.info(f"✅ Gemini model initialized: {model_name}")
+                        self.model_name = model_name
                         self.initialized = True
                         return True
                 except Exception as e:
@@ -109,6 +165,12 @@ class GeminiFreeCaptionGenerator:
             logger.error(f"Gemini initialization failed: {e}")
             return False
     
+    def cassette_stats(self) -> Optional[dict]:
+        """Cassette mode plus replay hit/miss counts."""
+        if not self.cassette:
+            return None
+        return {"mode": self.cassette_mode, **self.cassette.stats()}
+    
     def wait_for_rate_limit(self):
         """Wait to avoid rate limiting."""
         current_time = time.time()
@@ -117,13 +179,17 @@ class GeminiFreeCaptionGenerator:
             time.sleep(self.request_delay - time_since_last)
         self.last_request_time = time.time()
     
-    def generate_captions(self, image_bytes: bytes) -> Optional[List[str]]:
-        """Generate captions using Gemini free tier."""
-        if not self.initialized or not self.model:
+    def generate_captions(self, image_bytes: bytes, count: int = 3) -> Optional[List[str]]:
+        """Generate captions using Gemini free tier.
+        
+        Returns at least 3 captions, and up to `count` when more are requested.
+        """
+        if not self.initialized or (not self.model and self.cassette_mode != "replay"):
             logger.error("Gemini not initialized")
             return None
         
-        self.wait_for_rate_limit()
+        if self.cassette_mode != "replay":
+            self.wait_for_rate_limit()
         
         try:
             # Prepare the image
@@ -133,36 +199,38 @@ class GeminiFreeCaptionGenerator:
             if image.mode != 'RGB':
                 image = image.convert('RGB')
             
-            # Optimized prompt for better results
-            prompt = prompt = """Generate 3 short, engaging Instagram captions for this photo. 
-                Each caption should follow a different style:
-                1. The first caption should be aesthetic and visually pleasing ✨
-                2. The second caption should be poetic or quote-like, inspired by the mood or meaning of the photo 📝
-                3. The third caption should be modern, trendy, or relatable — something that connects with today's social media vibe 🔥
-                
-                Each caption must be:
-                - Under 10 words
-                - Creative and original
-                - Include relevant emojis
-                - Suitable for Instagram posts
-                
-                Return exactly 3 captions, one per line, without any numbers or bullets.
-                
-                Example:
-                Golden hour whispers through the waves 🌅
-                Even silence tells a story 🌻
-                Chasing moments, not things 💫"""
-
+            prompt = self.build_prompt(count)
             
             # Generate content
-            response = self.model.generate_content([prompt, image])
+            started = time.perf_counter()
+            text, input_tokens, output_tokens, truncated = self.request_text(prompt, image, image_bytes, count)
+            latency = time.perf_counter() - started
+            
+            # A line cut off by max_output_tokens is not a caption
+            if truncated and text and self.template.output == "lines":
+                logger.warning("Gemini response hit max_output_tokens; dropping the partial last line")
+                text = text.rsplit("\n", 1)[0] if "\n" in text.strip() else ""
             
-            if response and response.text:
-                logger.info(f"Gemini response received")
-                return self.parse_gemini_response(response.text)
-            else:
+            estimated = input_tokens is None or output_tokens is None
+            if input_tokens is None:
+                input_tokens = estimate_tokens(prompt) + IMAGE_TOKENS
+            if output_tokens is None:
+                output_tokens = estimate_tokens(text)
+            
+            if not text:
                 logger.warning("Gemini returned empty response")
+                self.token_usage.record(self.template.key, input_tokens, 0, latency, False, estimated, truncated)
                 return None
+            
+            logger.info(
+                f"Gemini response received ({self.template.key}: {input_tokens} input / "
+                f"{output_tokens} output tokens{', estimated' if estimated else ''})"
+            )
+            captions = self.parse_gemini_response(text, limit=count, output=self.template.output)
+            self.token_usage.record(
+                self.template.key, input_tokens, output_tokens, latency, bool(captions), estimated, truncated
+            )
+            return captions
                 
         except Exception as e:
             logger.error(f"Gemini generation error: {e}")
@@ -171,20 +239,72 @@ class GeminiFreeCaptionGenerator:
                 self.request_delay += 2
             return None
     
-    def parse_gemini_response(self, text: str) -> List[str]:
-        """Parse Gemini response into clean captions."""
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
+    def request_text(
+        self, prompt: str, image: Image.Image, image_bytes: bytes, count: int
+    ) -> Tuple[Optional[str], Optional[int], Optional[int], bool]:
+        """Raw response text, reported (input, output) token counts and whether the reply was cut off.
+        
+        Responses are recorded to or replayed from the cassette when enabled.
+        Token counts are None when the API does not report them.
+        """
+        if self.cassette_mode == "replay":
+            digest = hashlib.sha256(image_bytes).hexdigest()
+            recording = self.cassette.lookup(digest, prompt, output=self.template.output)
+            if recording is None:
+                logger.warning(f"No recording for image {digest[:12]}")
+                return None, None, None, False
+            time.sleep(replay_delay(recording["latency"], self.replay_speed))
+            return recording["response"], None, None, False
+        
+        started = time.perf_counter()
+        response = self.model.generate_content(
+            [prompt, image],
+            generation_config=self.template.generation_config(count)
+        )
+        text = response.text if response else None
+        usage = getattr(response, "usage_metadata", None)
+        candidates = getattr(response, "candidates", None) or []
+        finish_reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+        truncated = getattr(finish_reason, "name", str(finish_reason)) == "MAX_TOKENS"
+        
+        if self.cassette_mode == "record":
+            self.cassette.record(
+                hashlib.sha256(image_bytes).hexdigest(), prompt, self.model_name, text,
+                time.perf_counter() - started, caption_count=count
+            )
+        return (
+            text,
+            getattr(usage, "prompt_token_count", None),
+            getattr(usage, "candidates_token_count", None),
+            truncated
+        )
+    
+    def build_prompt(self, count: int = 3) -> str:
+        """Render the active prompt template for `count` captions."""
+        return self.template.render(count)
+    
+    def parse_gemini_response(self, text: str, limit: int = 3, output: str = "lines") -> List[str]:
+        """Parse Gemini response into clean captions.
+        
+        JSON replies are decoded directly (complete items only when cut off);
+        only replies without any JSON array go through the line parser.
+        """
+        lines = parse_json_captions(text) if output == "json" else None
+        if lines is None:
+            lines = [line.strip() for line in text.split('\n') if line.strip()]
         captions = []
         
         for line in lines:
             # Clean the line
             clean_line = self.clean_caption_line(line)
-            if clean_line and self.is_valid_caption(clean_line):
+            if clean_line and self.is_valid_caption(clean_line) and clean_line not in captions:
                 captions.append(clean_line)
-            if len(captions) >= 3:
+            if len(captions) >= limit:
                 break
         
         # If we don't have 3 captions, create variations
+        if len(captions) > 3:
+            return captions
         if captions:
             return self.ensure_three_captions(captions)
         else:
@@ -194,11 +314,11 @@ class GeminiFreeCaptionGenerator:
     def clean_caption_line(self, line: str) -> str:
         """Clean a single caption line."""
         # Remove numbering (1., 2., 3., etc.)
-        line = re.sub(r'^\d+[\.\)]\s*', '', line)
+        line = CAPTION_NUMBERING.sub('', line)
         # Remove bullets (-, •, *, etc.)
-        line = re.sub(r'^[•\-*]\s*', '', line)
+        line = CAPTION_BULLET.sub('', line)
         # Remove quotes
-        line = re.sub(r'^["\']|["\']$', '', line)
+        line = CAPTION_QUOTES.sub('', line)
         
         line = line.strip()
         
@@ -277,8 +397,54 @@ class GeminiFreeCaptionGenerator:
 # Initialize Gemini generator
 gemini_generator = GeminiFreeCaptionGenerator()
 
-# Initialize Database
-db = Database()
+# Per-user fair scheduling in front of the shared Gemini quota
+# Replayed traffic is paced by its recordings, not by the live quota
+replaying = gemini_generator.cassette_mode == "replay"
+caption_scheduler = FairQueueScheduler(
+    min_interval=lambda: 0 if replaying else gemini_generator.request_delay,
+    user_rate=float(os.environ.get("SCHEDULER_USER_RATE", "0.5")),
+    user_burst=float(os.environ.get("SCHEDULER_USER_BURST", "5")),
+    anonymous_rate=float(os.environ.get("SCHEDULER_ANON_RATE", "0.2")),
+    anonymous_burst=float(os.environ.get("SCHEDULER_ANON_BURST", "3")),
+    max_queue_per_user=int(os.environ.get("SCHEDULER_MAX_QUEUE_PER_USER", "10")),
+    anonymous_max_queue=int(os.environ.get("SCHEDULER_ANON_MAX_QUEUE", "20")),
+    anonymous_weight=float(os.environ.get("SCHEDULER_ANON_WEIGHT", "0.5")),
+    rate_limited=not replaying
+)
+
+# Admission control for the caption path
+caption_admission = AdmissionController(
+    max_concurrency=int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "8")),
+    min_concurrency=int(os.environ.get("ADMISSION_MIN_CONCURRENCY", "1")),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", "16")),
+    queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30")),
+    target_latency=float(os.environ.get("ADMISSION_TARGET_LATENCY", "10"))
+)
+
+# Spare captions per image digest for instant regeneration
+caption_pool = CaptionPool(
+    max_images=int(os.environ.get("CAPTION_POOL_MAX_IMAGES", "1000")),
+    ttl=float(os.environ.get("CAPTION_POOL_TTL", "3600"))
+)
+
+# Uploaded images and thumbnails, stored once per digest
+blob_store = BlobStore(
+    root=os.environ.get("BLOB_DIR", "blobs"),
+    thumbnail_size=int(os.environ.get("THUMBNAIL_SIZE", "256"))
+)
+
+# Initialize Database (sharded by user when STORAGE_SHARDS > 1)
+db = create_storage(
+    write_behind=os.environ.get("WRITE_BEHIND_ENABLED", "").lower() in ("1", "true", "yes"),
+    flush_interval=float(os.environ.get("WRITE_BEHIND_FLUSH_MS", "50")) / 1000,
+    max_batch=int(os.environ.get("WRITE_BEHIND_MAX_BATCH", "256"))
+)
+
+# Initialize similarity index over past Gemini captions
+similarity_index = CaptionSimilarityIndex(
+    index_dir=os.environ.get("SIMILARITY_INDEX_DIR", "similarity_index"),
+    min_score=float(os.environ.get("SIMILARITY_MIN_SCORE", "0.9"))
+)
 
 # Pydantic models for requests
 class RegisterRequest(BaseModel):
@@ -311,6 +477,54 @@ async def get_current_user(authorization: str = Header(None)) -> int:
     
     return user_id
 
+def file_digest(fileobj, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file object, read in chunks and rewound afterwards."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def validate_image_upload(file: UploadFile):
+    """400 unless the upload is a non-empty image of at most MAX_UPLOAD_SIZE bytes."""
+    if file is None or not file.filename:
+        raise HTTPException(status_code=400, detail="No file uploaded.")
+    
+    file.file.seek(0, 2)
+    file_size = file.file.tell()
+    file.file.seek(0)
+
+    logger.info(
+        "Upload received: filename=%s content_type=%s size=%s bytes",
+        getattr(file, "filename", None), getattr(file, "content_type", None), file_size,
+    )
+    
+    if file_size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB.")
+    
+    if not (file.content_type and file.content_type.startswith("image/")):
+        raise HTTPException(status_code=400, detail="Unsupported file type. Please upload an image.")
+
+    if not file_size:
+        raise HTTPException(status_code=400, detail="Empty file provided.")
+
+async def admit_caption_request():
+    """Take an admission slot or shed the request with 503; release it with caption_admission.release()."""
+    try:
+        await caption_admission.acquire()
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Caption service is busy. Please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+def require_conversation(conversation_id: int, user_id: int):
+    """404 unless the conversation exists and belongs to the user."""
+    if db.conversation_owner(conversation_id) != user_id:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
 app = FastAPI(title=APP_NAME)
 
 app.add_middleware(
@@ -319,17 +533,61 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# Opt-in profiling; nothing is installed unless one of the triggers is configured
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "").strip()
+
+request_profiler = None
+if os.environ.get("PROFILE_EVERY_N") or os.environ.get("PROFILE_SLOW_MS"):
+    request_profiler = RequestProfiler(
+        output_dir=PROFILE_DIR,
+        every_n=int(os.environ.get("PROFILE_EVERY_N", "0")),
+        slow_ms=float(os.environ.get("PROFILE_SLOW_MS", "0")),
+        interval=float(os.environ.get("PROFILE_INTERVAL_MS", "10")) / 1000
+    )
+
+    @app.middleware("http")
+    async def profile_requests(request: Request, call_next):
+        """Dump collapsed stacks for every Nth or slow request."""
+        started = time.monotonic()
+        response = await call_next(request)
+        finished = time.monotonic()
+        if request_profiler.should_dump((finished - started) * 1000):
+            # Aggregation and the file write happen off the event loop
+            request_profiler.dump(started, finished, f"{request.method}{request.url.path}")
+        return response
+
+async def require_admin(x_admin_token: str = Header(None)):
+    """Allow only callers presenting ADMIN_TOKEN; admin routes are hidden when it is unset."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize Gemini on startup."""
     logger.info("Starting Gemini Caption Generator...")
+    similarity_index.load()
+    caption_scheduler.start()
+    if request_profiler:
+        request_profiler.sampler.start()
     if gemini_generator.initialize():
         logger.info("✅ Gemini Free Tier initialized successfully")
     else:
         logger.warning("❌ Gemini initialization failed - using fallback mode")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the scheduler and flush pending database writes before exiting."""
+    await caption_scheduler.stop()
+    if request_profiler:
+        request_profiler.sampler.stop()
+    db.close()
+
 @app.get("/")
 async def root():
     return {
@@ -345,7 +603,16 @@ async def health():
         "status": "healthy",
         "gemini_available": gemini_generator.initialized,
         "has_gemini_library": HAS_GEMINI,
-        "rate_limit_delay": gemini_generator.request_delay
+        "rate_limit_delay": gemini_generator.request_delay,
+        "similarity_index": similarity_index.stats(),
+        "write_behind": db.write_stats(),
+        "scheduler": caption_scheduler.stats(),
+        "admission": caption_admission.stats(),
+        "caption_pool": caption_pool.stats(),
+        "gemini_cassette": gemini_generator.cassette_stats(),
+        "blob_store": blob_store.stats(),
+        "prompt_template": gemini_generator.template.key,
+        "prompt_tokens": gemini_generator.token_usage.stats()
     }
 
 # ============ Authentication Endpoints ============
@@ -416,19 +683,33 @@ async def create_conversation(user_id: int = Depends(get_current_user)):
     }
 
 @app.get("/conversations")
-async def get_conversations(user_id: int = Depends(get_current_user)):
+async def get_conversations(request: Request, user_id: int = Depends(get_current_user)):
     """Get all conversations for current user."""
-    conversations = db.get_user_conversations(user_id)
-    return {"conversations": conversations}
+    scope = conversations_scope(user_id)
+    return await conditional_json_response(
+        request,
+        make_etag(scope, db.get_version(scope)),
+        lambda: {"conversations": db.get_user_conversations(user_id)},
+        gzip_min_size=GZIP_MIN_SIZE,
+        gzip_level=GZIP_LEVEL
+    )
 
 @app.get("/conversations/{conversation_id}/messages")
 async def get_conversation_messages(
     conversation_id: int,
+    request: Request,
     user_id: int = Depends(get_current_user)
 ):
     """Get all messages in a conversation."""
-    messages = db.get_conversation_messages(conversation_id)
-    return {"messages": messages}
+    require_conversation(conversation_id, user_id)
+    scope = messages_scope(conversation_id)
+    return await conditional_json_response(
+        request,
+        make_etag(scope, db.get_version(scope)),
+        lambda: {"messages": db.get_conversation_messages(conversation_id)},
+        gzip_min_size=GZIP_MIN_SIZE,
+        gzip_level=GZIP_LEVEL
+    )
 
 @app.post("/conversations/{conversation_id}/messages")
 async def add_message_to_conversation(
@@ -437,13 +718,14 @@ async def add_message_to_conversation(
     user_id: int = Depends(get_current_user)
 ):
     """Add a message to a conversation."""
-    # Add user message
-    message_id = db.add_message(
+    require_conversation(conversation_id, user_id)
+    # Add user message (awaited so the response carries the committed id)
+    message_id = await asyncio.wrap_future(db.enqueue_message(
         conversation_id=conversation_id,
         role="user",
         content=request.content,
         captions=None
-    )
+    ))
     
     return {
         "message_id": message_id,
@@ -465,10 +747,16 @@ async def save_caption(
     }
 
 @app.get("/saved-captions")
-async def get_saved_captions(user_id: int = Depends(get_current_user)):
+async def get_saved_captions(request: Request, user_id: int = Depends(get_current_user)):
     """Get all saved captions for the user."""
-    captions = db.get_saved_captions(user_id)
-    return {"captions": captions}
+    scope = saved_captions_scope(user_id)
+    return await conditional_json_response(
+        request,
+        make_etag(scope, db.get_version(scope)),
+        lambda: {"captions": db.get_saved_captions(user_id)},
+        gzip_min_size=GZIP_MIN_SIZE,
+        gzip_level=GZIP_LEVEL
+    )
 
 @app.delete("/saved-captions/{caption_id}")
 async def delete_saved_caption(
@@ -481,6 +769,106 @@ async def delete_saved_caption(
         raise HTTPException(status_code=404, detail="Caption not found")
     return {"message": "Caption deleted successfully"}
 
+# ============ Search Endpoints ============
+
+@app.get("/search")
+async def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    kind: Optional[List[str]] = Query(None),
+    prefix: bool = True,
+    user_id: int = Depends(get_current_user)
+):
+    """Search saved captions, messages and generated captions."""
+    if kind and any(k not in SEARCH_KINDS for k in kind):
+        raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(SEARCH_KINDS)}")
+    
+    results = db.search(user_id, q, limit=limit, offset=offset, kinds=kind, prefix=prefix)
+    return {
+        "results": results,
+        "query": q,
+        "limit": limit,
+        "offset": offset
+    }
+
+# ============ Export / Import Endpoints ============
+
+@app.get("/export")
+async def export_data(user_id: int = Depends(get_current_user)):
+    """Stream the user's conversations, messages and saved captions as NDJSON."""
+    return StreamingResponse(
+        db.export_user_data(user_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="caption-maker-export-{user_id}.ndjson"'}
+    )
+
+@app.post("/import")
+async def import_data(request: Request, user_id: int = Depends(get_current_user)):
+    """Import an NDJSON export into the user's account.
+    
+    The body is consumed as a stream and committed in chunks of
+    IMPORT_CHUNK_SIZE records; chunks before a malformed line stay imported.
+    """
+    totals = {"conversations": 0, "messages": 0, "saved_captions": 0, "skipped": 0}
+    conversation_ids = {}
+    chunk = []
+    buffer = b""
+    line_number = 0
+    
+    def import_chunk():
+        # Only keep references to images this server actually stores
+        for record in chunk:
+            if record.get("image_digest") and not blob_store.contains(record["image_digest"]):
+                record["image_digest"] = None
+        for key, value in db.import_records(user_id, chunk, conversation_ids).items():
+            totals[key] += value
+        chunk.clear()
+    
+    def invalid(reason: str):
+        return HTTPException(
+            status_code=400,
+            detail={"error": f"{reason} on line {line_number}", "imported": totals}
+        )
+    
+    def parse_line(line: bytes):
+        nonlocal line_number
+        line_number += 1
+        if not line.strip():
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise invalid("Invalid JSON")
+        if not isinstance(record, dict):
+            raise invalid("Expected a JSON object")
+        for key in IMPORT_ID_KEYS.get(record.get("type"), ()):
+            if not isinstance(record.get(key), (int, str)) or isinstance(record.get(key), bool):
+                raise invalid(f"Missing or invalid '{key}'")
+        for key in IMPORT_TEXT_KEYS:
+            if record.get(key) is not None and not isinstance(record[key], str):
+                raise invalid(f"Invalid '{key}'")
+        captions = record.get("captions")
+        if captions is not None and not (
+            isinstance(captions, list) and all(isinstance(caption, str) for caption in captions)
+        ):
+            raise invalid("Invalid 'captions'")
+        chunk.append(record)
+    
+    # Chunks are committed off the event loop
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            parse_line(line)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                await run_in_threadpool(import_chunk)
+    parse_line(buffer)
+    if chunk:
+        await run_in_threadpool(import_chunk)
+    
+    return {"message": "Import completed", "imported": totals}
+
 @app.get("/available-models")
 async def available_models():
     """List all available Gemini models."""
@@ -521,33 +909,54 @@ async def generate_captions(
     if authorization and authorization.startswith("Bearer "):
         token = authorization.replace("Bearer ", "")
         user_id = db.verify_session(token)
+    if conversation_id and user_id:
+        require_conversation(conversation_id, user_id)
     
     # Basic validation
-    if file is None or not file.filename:
-        raise HTTPException(status_code=400, detail="No file uploaded.")
+    validate_image_upload(file)
     
-    MAX_FILE_SIZE = 10 * 1024 * 1024
-    file.file.seek(0, 2)
-    file_size = file.file.tell()
-    file.file.seek(0)
-
-    logger.info(
-        "Upload received: filename=%s content_type=%s size=%s bytes",
-        getattr(file, "filename", None), getattr(file, "content_type", None), file_size,
-    )
+    # Hash the spooled upload in chunks; it is only read into memory once admitted
+    image_digest = await run_in_threadpool(file_digest, file.file)
     
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB.")
+    # Regenerate requests for a recent image are served from the pre-generated pool
+    pooled_captions = caption_pool.take(image_digest, 3)
+    if pooled_captions:
+        logger.info("Serving captions from regenerate pool")
+        if conversation_id and user_id:
+            if not blob_store.contains(image_digest):
+                await run_in_threadpool(blob_store.put, image_digest, await file.read())
+            db.enqueue_message(
+                conversation_id=conversation_id,
+                role="bot",
+                content="Generated captions for your image",
+                captions=pooled_captions,
+                image_digest=image_digest
+            )
+        return JSONResponse({"captions": pooled_captions})
+
+    # Wait for this caller's turn at Gemini first: queued requests sit in their
+    # own bounded scheduler lane and do not hold admission slots
+    if gemini_generator.initialized:
+        try:
+            await caption_scheduler.acquire(user_id)
+        except SchedulerQueueFull as e:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many caption requests in progress. Please retry shortly.",
+                headers={"Retry-After": str(int(e.retry_after) + 1)}
+            )
     
-    if not (file.content_type and file.content_type.startswith("image/")):
-        raise HTTPException(status_code=400, detail="Unsupported file type. Please upload an image.")
+    # Shed load before the image is decoded
+    await admit_caption_request()
 
     try:
         image_bytes = await file.read()
-        logger.info("Read %s bytes from upload", len(image_bytes) if image_bytes else 0)
-        if not image_bytes:
-            raise HTTPException(status_code=400, detail="Empty file provided.")
-
+        logger.info("Read %s bytes from upload", len(image_bytes))
+        
+        # Keep the photo for conversation history; repeat uploads are a no-op
+        if conversation_id and user_id:
+            await run_in_threadpool(blob_store.put, image_digest, image_bytes)
+        
         # Analyze image for fallback
         img = Image.open(io.BytesIO(image_bytes))
         image_info = {
@@ -555,37 +964,55 @@ async def generate_captions(
             "size": img.size,
             "mode": img.mode
         }
+        features = await run_in_threadpool(extract_features, img)
 
         # Try Gemini first
         gemini_captions = None
         if gemini_generator.initialized:
-            gemini_captions = gemini_generator.generate_captions(image_bytes)
+            gemini_started = time.monotonic()
+            gemini_captions = await run_in_threadpool(
+                gemini_generator.generate_captions, image_bytes, CAPTION_POOL_SIZE
+            )
+            caption_admission.record_latency(time.monotonic() - gemini_started)
         
         if gemini_captions:
             logger.info("Successfully generated Gemini captions")
+            await run_in_threadpool(similarity_index.add, features, gemini_captions, image_digest)
+            
+            # Keep the extras for regenerate requests
+            caption_pool.put(image_digest, gemini_captions[3:])
+            gemini_captions = gemini_captions[:3]
             
             # Save to database if conversation_id and user_id provided
             if conversation_id and user_id:
-                db.add_message(
+                db.enqueue_message(
                     conversation_id=conversation_id,
                     role="bot",
                     content="Generated captions for your image",
-                    captions=gemini_captions
+                    captions=gemini_captions,
+                    image_digest=image_digest
                 )
             
             return JSONResponse({"captions": gemini_captions})
         
-        # Fallback to smart mock captions
-        logger.info("Using fallback captions")
-        fallback_captions = generate_smart_fallback_captions(image_info)
+        # Serve captions of similar past images before generic fallbacks
+        similar_captions = await run_in_threadpool(similarity_index.suggest_captions, features)
+        if similar_captions:
+            logger.info("Using captions from similar images")
+            fallback_captions = gemini_generator.ensure_three_captions(similar_captions)
+        else:
+            # Fallback to smart mock captions
+            logger.info("Using fallback captions")
+            fallback_captions = generate_smart_fallback_captions(image_info)
         
         # Save to database if conversation_id and user_id provided
         if conversation_id and user_id:
-            db.add_message(
+            db.enqueue_message(
                 conversation_id=conversation_id,
                 role="bot",
                 content="Generated captions for your image",
-                captions=fallback_captions
+                captions=fallback_captions,
+                image_digest=image_digest
             )
         
         return JSONResponse({"captions": fallback_captions})
@@ -601,6 +1028,58 @@ async def generate_captions(
         ]
         
         return JSONResponse({"captions": basic_captions})
+    finally:
+        caption_admission.release()
+
+@app.post("/suggest-captions")
+async def suggest_captions(file: UploadFile = File(...), user_id: int = Depends(get_current_user)):
+    """Instant caption suggestions from similar previously captioned images."""
+    validate_image_upload(file)
+    
+    await admit_caption_request()
+    try:
+        img = Image.open(io.BytesIO(await file.read()))
+        features = await run_in_threadpool(extract_features, img)
+    except Exception as e:
+        logger.info(f"Could not decode upload for suggestions: {e}")
+        raise HTTPException(status_code=400, detail="Could not read the image. Please upload a valid image.")
+    finally:
+        caption_admission.release()
+    
+    captions = await run_in_threadpool(similarity_index.suggest_captions, features) or []
+    return {"captions": captions, "source": "similarity-index"}
+
+@app.get("/images/{digest}/thumbnail")
+async def get_thumbnail(digest: str, user_id: int = Depends(get_current_user)):
+    """Serve the thumbnail of an upload referenced by one of the user's messages.
+    
+    Blobs are addressed by content, so the response never changes; it may be
+    cached forever, but only by the client since uploads are private.
+    """
+    path = blob_store.thumbnail_path(digest)
+    if not path or not db.user_has_image(user_id, digest):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    return FileResponse(
+        path,
+        media_type="image/jpeg",
+        headers={"Cache-Control": "private, max-age=31536000, immutable"}
+    )
+
+# ============ Admin Endpoints ============
+
+@app.post("/admin/profile", status_code=202, dependencies=[Depends(require_admin)])
+async def start_profile(
+    seconds: float = Query(10, gt=0, le=300),
+    interval_ms: float = Query(5, ge=1, le=1000)
+):
+    """Sample this worker for a while and write a collapsed-stack flamegraph file."""
+    output = profile_for(seconds, PROFILE_DIR, interval=interval_ms / 1000)
+    return {
+        "message": "Profiling started",
+        "seconds": seconds,
+        "output": output
+    }
 
 @app.get("/debug-models")
 async def debug_models():
@@ -0,0 +1,150 @@
+import os
+import re
+import sys
+import time
+import itertools
+import threading
+import logging
+from collections import Counter, deque
+from typing import Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Profiler threads are left out of the samples
+PROFILER_THREADS = ("sampling-profiler", "profile-session", "profile-dump")
+
+# Disambiguates sessions started within the same second
+_session_ids = itertools.count(1)
+
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler for every thread of the running worker.
+
+    A background thread snapshots `sys._current_frames()` every `interval`
+    seconds and keeps the last `history` seconds of samples, so callers can
+    cut out the window a slow request ran in. Stacks are emitted in the
+    collapsed format (`root;child;leaf count`) read by flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, interval: float = 0.01, history: float = 60.0):
+        self.interval = interval
+        self.samples: Deque[Tuple[float, str]] = deque(maxlen=max(1, int(history / interval)))
+        self._stack_cache: Dict[tuple, str] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                name = names.get(thread_id, str(thread_id))
+                if thread_id != own_id and name not in PROFILER_THREADS:
+                    self.samples.append((now, self._collapse(name, frame)))
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        key = (thread_name, tuple(codes))
+
+        stack = self._stack_cache.get(key)
+        if stack is None:
+            frames = [f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                      for code in reversed(codes)]
+            stack = ";".join([f"thread:{thread_name}"] + frames)
+            if len(self._stack_cache) < 50000:
+                self._stack_cache[key] = stack
+        return stack
+
+    def collapsed(self, since: float = 0.0, until: float = float("inf")) -> Counter:
+        """Aggregate samples taken between two `time.monotonic()` values."""
+        return Counter(stack for taken, stack in list(self.samples) if since <= taken <= until)
+
+
+def collapsed_path(output_dir: str, name: str) -> str:
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_")
+    return os.path.join(output_dir, f"{safe_name}.collapsed")
+
+
+def write_collapsed(stacks: Counter, output_dir: str, name: str) -> str:
+    """Write collapsed stacks to `collapsed_path(output_dir, name)` and return the path."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = collapsed_path(output_dir, name)
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+def profile_for(seconds: float, output_dir: str, interval: float = 0.005) -> str:
+    """Run a timed profiling session in the background; returns the output path."""
+    name = f"{time.strftime('session-%Y%m%d-%H%M%S')}-{next(_session_ids)}"
+    path = collapsed_path(output_dir, name)
+
+    def run():
+        profiler = SamplingProfiler(interval=interval, history=seconds + 1)
+        profiler.start()
+        time.sleep(seconds)
+        profiler.stop()
+        write_collapsed(profiler.collapsed(), output_dir, name)
+        logger.info(f"Profiling session written to {path} ({len(profiler.samples)} samples)")
+
+    threading.Thread(target=run, name="profile-session", daemon=True).start()
+    return path
+
+
+class RequestProfiler:
+    """Keeps a continuous sampler running and dumps the window of selected requests.
+
+    A request is dumped when it is every `every_n`-th request or took longer
+    than `slow_ms`. Samples cover all threads during the request's lifetime,
+    so concurrent requests show up in each other's profiles.
+    """
+
+    def __init__(self, output_dir: str, every_n: int = 0, slow_ms: float = 0, interval: float = 0.01):
+        self.output_dir = output_dir
+        self.every_n = every_n
+        self.slow_ms = slow_ms
+        self.sampler = SamplingProfiler(interval=interval)
+        self.requests = 0
+        self.dumps = 0
+
+    def should_dump(self, elapsed_ms: float) -> bool:
+        self.requests += 1
+        if self.every_n and self.requests % self.every_n == 0:
+            return True
+        return bool(self.slow_ms) and elapsed_ms >= self.slow_ms
+
+    def dump(self, started: float, finished: float, label: str) -> str:
+        """Write the request's samples from a background thread; returns the output path."""
+        self.dumps += 1
+        elapsed_ms = (finished - started) * 1000
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.dumps}-{label}-{elapsed_ms:.0f}ms"
+
+        def run():
+            path = write_collapsed(self.sampler.collapsed(started, finished), self.output_dir, name)
+            logger.info(f"Request profile written to {path}")
+
+        threading.Thread(target=run, name="profile-dump", daemon=True).start()
+        return collapsed_path(self.output_dir, name)
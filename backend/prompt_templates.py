@@ -0,0 +1,237 @@
+import re
+import json
+import math
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Gemini bills an image as a fixed number of input tokens
+IMAGE_TOKENS = 258
+
+# Styles used when asking for a larger caption set in one call
+CAPTION_STYLES = [
+    "aesthetic and visually pleasing ✨",
+    "poetic or quote-like, inspired by the mood of the photo 📝",
+    "modern, trendy or relatable 🔥",
+    "funny or playful 😄",
+    "motivational or uplifting 💪",
+    "short and minimalist 🤍",
+]
+
+# Original prompt, kept verbatim so existing cassettes still match
+LEGACY_PROMPT = """Generate 3 short, engaging Instagram captions for this photo. 
+                Each caption should follow a different style:
+                1. The first caption should be aesthetic and visually pleasing ✨
+                2. The second caption should be poetic or quote-like, inspired by the mood or meaning of the photo 📝
+                3. The third caption should be modern, trendy, or relatable — something that connects with today's social media vibe 🔥
+                
+                Each caption must be:
+                - Under 10 words
+                - Creative and original
+                - Include relevant emojis
+                - Suitable for Instagram posts
+                
+                Return exactly 3 captions, one per line, without any numbers or bullets.
+                
+                Example:
+                Golden hour whispers through the waves 🌅
+                Even silence tells a story 🌻
+                Chasing moments, not things 💫"""
+
+LEGACY_SET_PROMPT = """Generate {count} short, engaging Instagram captions for this photo.
+Spread them evenly across these styles:
+{styles}
+
+Each caption must be:
+- Under 10 words
+- Creative and original
+- Include relevant emojis
+- Suitable for Instagram posts
+
+Return exactly {count} captions, one per line, without any numbers, bullets or style labels."""
+
+JSON_ARRAY = re.compile(r"\[.*\]", re.DOTALL)
+# A complete string item inside a (possibly truncated) JSON array
+JSON_ARRAY_ITEM = re.compile(r'"((?:[^"\\]|\\.)*)"\s*[,\]]')
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) when the API reports none."""
+    return math.ceil(len(text or "") / 4)
+
+
+def parse_json_captions(text: str) -> Optional[List[str]]:
+    """Captions from a JSON array reply, tolerating code fences and surrounding prose.
+
+    A reply cut off mid-array (e.g. by max_output_tokens) yields only its
+    complete string items. Returns None when the reply contains no array
+    at all, so callers can fall back to the line parser.
+    """
+    start = (text or "").find("[")
+    if start < 0:
+        return None
+
+    match = JSON_ARRAY.search(text, start)
+    if match:
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            data = None
+        if isinstance(data, list):
+            return [item.strip() for item in data if isinstance(item, str) and item.strip()]
+
+    items = []
+    for raw in JSON_ARRAY_ITEM.findall(text, start):
+        try:
+            item = json.loads(f'"{raw}"').strip()
+        except ValueError:
+            continue
+        if item:
+            items.append(item)
+    return items
+
+
+class PromptTemplate:
+    """A versioned caption prompt with its output format and token budget.
+
+    `output` is "lines" (one caption per line) or "json" (a JSON array of
+    strings). The output budget grows with the number of captions asked
+    for: `base_output_tokens + tokens_per_caption * count`. A caption of
+    under ten words with emojis is typically 15-30 tokens; the defaults
+    leave room for JSON quoting and code fences so replies are not cut off.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        version: int,
+        text: str,
+        set_text: Optional[str] = None,
+        output: str = "lines",
+        tokens_per_caption: int = 40,
+        base_output_tokens: int = 64
+    ):
+        self.name = name
+        self.version = version
+        self.text = text
+        self.set_text = set_text or text
+        self.output = output
+        self.tokens_per_caption = tokens_per_caption
+        self.base_output_tokens = base_output_tokens
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}-v{self.version}"
+
+    def render(self, count: int = 3) -> str:
+        if count <= 3:
+            return self.text.format(count=3, styles="\n".join(f"- {style}" for style in CAPTION_STYLES[:3]))
+        styles = "\n".join(f"- {style}" for style in CAPTION_STYLES)
+        return self.set_text.format(count=count, styles=styles)
+
+    def max_output_tokens(self, count: int = 3) -> int:
+        return self.base_output_tokens + self.tokens_per_caption * max(count, 3)
+
+    def generation_config(self, count: int = 3) -> Dict[str, Any]:
+        return {"max_output_tokens": self.max_output_tokens(count)}
+
+
+def _register(*templates: PromptTemplate) -> Dict[str, PromptTemplate]:
+    return {template.key: template for template in templates}
+
+
+PROMPT_TEMPLATES = _register(
+    PromptTemplate(
+        "lines", 1,
+        LEGACY_PROMPT,
+        LEGACY_SET_PROMPT
+    ),
+    PromptTemplate(
+        "lines", 2,
+        """Write {count} Instagram captions for this photo, one per line, no numbering or labels.
+Styles, spread evenly:
+{styles}
+Each under 10 words, original, with emojis."""
+    ),
+    PromptTemplate(
+        "json", 1,
+        """Write {count} Instagram captions for this photo.
+Styles, spread evenly:
+{styles}
+Each under 10 words, original, with emojis.
+Reply with only a JSON array of {count} strings.""",
+        output="json"
+    ),
+)
+
+# Behaviour-preserving default; override with PROMPT_TEMPLATE after benchmarking
+DEFAULT_TEMPLATE = "lines-v1"
+
+
+def get_template(key: Optional[str]) -> PromptTemplate:
+    """Look up a template by key, falling back to the default."""
+    if key and key not in PROMPT_TEMPLATES:
+        logger.warning(f"Unknown prompt template {key!r}, using {DEFAULT_TEMPLATE}")
+    return PROMPT_TEMPLATES.get(key or DEFAULT_TEMPLATE, PROMPT_TEMPLATES[DEFAULT_TEMPLATE])
+
+
+def match_template(prompt: str, count: int) -> Optional[PromptTemplate]:
+    """Template that renders to exactly this prompt, if any."""
+    for template in PROMPT_TEMPLATES.values():
+        if template.render(count) == prompt:
+            return template
+    return None
+
+
+class TokenUsage:
+    """Per-template request counts, token totals, latency and parse outcomes."""
+
+    def __init__(self):
+        self.templates: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        template: str,
+        input_tokens: int,
+        output_tokens: int,
+        latency: float,
+        parsed: bool,
+        estimated: bool = False,
+        truncated: bool = False
+    ):
+        with self._lock:
+            entry = self.templates.setdefault(template, {
+                "requests": 0,
+                "parsed": 0,
+                "estimated": 0,
+                "truncated": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "latency_s": 0.0,
+            })
+            entry["requests"] += 1
+            entry["parsed"] += int(parsed)
+            entry["estimated"] += int(estimated)
+            entry["truncated"] += int(truncated)
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["latency_s"] += latency
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for template, entry in self.templates.items():
+                requests = entry["requests"] or 1
+                result[template] = {
+                    "requests": entry["requests"],
+                    "parse_success_rate": round(entry["parsed"] / requests, 4),
+                    "estimated_counts": entry["estimated"],
+                    "truncated": entry["truncated"],
+                    "avg_input_tokens": round(entry["input_tokens"] / requests, 1),
+                    "avg_output_tokens": round(entry["output_tokens"] / requests, 1),
+                    "avg_latency_s": round(entry["latency_s"] / requests, 3),
+                }
+            return result
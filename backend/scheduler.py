@@ -0,0 +1,261 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+ANONYMOUS_KEY = "anonymous"
+
+
+class SchedulerQueueFull(Exception):
+    """Raised when a caller already has too many requests waiting."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too many queued caption requests")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """Seconds until one token is available (0 if available now)."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+
+class FairQueueScheduler:
+    """Deficit-round-robin dispatcher over per-user queues for the shared Gemini quota.
+
+    Every caller (each logged-in user, plus one shared lane for anonymous
+    traffic) gets its own FIFO queue, token bucket and DRR weight. A single
+    dispatcher task releases one waiter at a time, spaced by the generator's
+    current rate-limit delay, so a user uploading a batch of photos only
+    delays their own requests.
+    """
+
+    def __init__(
+        self,
+        min_interval: Callable[[], float],
+        user_rate: float = 0.5,
+        user_burst: float = 5,
+        anonymous_rate: float = 0.2,
+        anonymous_burst: float = 3,
+        max_queue_per_user: int = 10,
+        anonymous_max_queue: int = 20,
+        anonymous_weight: float = 0.5,
+        rate_limited: bool = True,
+    ):
+        self.min_interval = min_interval
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.anonymous_rate = anonymous_rate
+        self.anonymous_burst = anonymous_burst
+        self.max_queue_per_user = max_queue_per_user
+        self.anonymous_max_queue = anonymous_max_queue
+        self.anonymous_weight = anonymous_weight
+        # When False the per-caller token buckets are bypassed (e.g. replayed traffic)
+        self.rate_limited = rate_limited
+
+        # Active queues in round-robin order
+        self.queues: "OrderedDict[str, Deque[Tuple[asyncio.Future, float]]]" = OrderedDict()
+        self.deficits: Dict[str, float] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.last_dispatch = 0.0
+
+        self.wait_stats = {
+            "authenticated": {"count": 0, "total": 0.0, "max": 0.0, "recent": deque(maxlen=500)},
+            "anonymous": {"count": 0, "total": 0.0, "max": 0.0, "recent": deque(maxlen=500)},
+        }
+
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def key_for(user_id: Optional[int]) -> str:
+        return f"user:{user_id}" if user_id else ANONYMOUS_KEY
+
+    def _bucket(self, key: str) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                self._prune_buckets()
+            if key == ANONYMOUS_KEY:
+                bucket = TokenBucket(self.anonymous_rate, self.anonymous_burst)
+            else:
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+            self.buckets[key] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        """Forget idle users whose buckets have refilled completely."""
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if key not in self.queues and bucket.tokens >= bucket.capacity:
+                del self.buckets[key]
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def acquire(self, user_id: Optional[int]) -> float:
+        """Wait for this caller's turn; returns the time spent queued in seconds."""
+        key = self.key_for(user_id)
+        queue = self.queues.get(key)
+        limit = self.anonymous_max_queue if key == ANONYMOUS_KEY else self.max_queue_per_user
+        if queue is not None and len(queue) >= limit:
+            raise SchedulerQueueFull(retry_after=len(queue) * max(self.min_interval(), 1.0))
+
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.deficits[key] = 0.0
+
+        future = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        queue.append((future, enqueued))
+        self._wakeup.set()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._discard(key, future)
+            raise
+
+        waited = time.monotonic() - enqueued
+        self._record_wait(key, waited)
+        return waited
+
+    def _discard(self, key: str, future: asyncio.Future):
+        queue = self.queues.get(key)
+        if queue is None:
+            return
+        for item in queue:
+            if item[0] is future:
+                queue.remove(item)
+                break
+        if not queue:
+            self._deactivate(key)
+
+    def _deactivate(self, key: str):
+        self.queues.pop(key, None)
+        self.deficits.pop(key, None)
+
+    def _record_wait(self, key: str, waited: float):
+        stats = self.wait_stats["anonymous" if key == ANONYMOUS_KEY else "authenticated"]
+        stats["count"] += 1
+        stats["total"] += waited
+        stats["max"] = max(stats["max"], waited)
+        stats["recent"].append(waited)
+
+    def _pick(self, now: float) -> Tuple[Optional[asyncio.Future], float]:
+        """Choose the next waiter by DRR; returns (future, 0) or (None, seconds to retry)."""
+        blocked_for = float("inf")
+        visits = 0
+        # Each visit either serves, adds credit, or skips a rate-limited queue, so this terminates
+        max_visits = len(self.queues) * (int(1 / min(self.anonymous_weight, 1.0)) + 2)
+
+        while self.queues and visits < max_visits:
+            visits += 1
+            key, queue = next(iter(self.queues.items()))
+
+            # Drop waiters whose requests were cancelled
+            while queue and queue[0][0].done():
+                queue.popleft()
+            if not queue:
+                self._deactivate(key)
+                continue
+
+            ready_in = self._bucket(key).ready_in(now) if self.rate_limited else 0.0
+            if ready_in > 0:
+                blocked_for = min(blocked_for, ready_in)
+                self.queues.move_to_end(key)
+                continue
+
+            if self.deficits[key] < 1:
+                weight = self.anonymous_weight if key == ANONYMOUS_KEY else 1.0
+                self.deficits[key] += weight
+                if self.deficits[key] < 1:
+                    self.queues.move_to_end(key)
+                    continue
+
+            self.deficits[key] -= 1
+            if self.rate_limited:
+                self._bucket(key).take(now)
+            future, _ = queue.popleft()
+            if not queue:
+                self._deactivate(key)
+            elif self.deficits[key] < 1:
+                self.queues.move_to_end(key)
+            return future, 0.0
+
+        return None, blocked_for
+
+    async def _dispatch_loop(self):
+        while True:
+            if not self.queues:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Space dispatches by the shared Gemini rate limit
+            delay = self.last_dispatch + self.min_interval() - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            future, retry_in = self._pick(time.monotonic())
+            if future is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(retry_in, 60))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            future.set_result(None)
+            self.last_dispatch = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        wait_times = {}
+        for user_class, stats in self.wait_stats.items():
+            recent = sorted(stats["recent"])
+            wait_times[user_class] = {
+                "requests": stats["count"],
+                "avg_wait_ms": round(stats["total"] / stats["count"] * 1000, 1) if stats["count"] else 0,
+                "p95_wait_ms": round(recent[int(len(recent) * 0.95)] * 1000, 1) if recent else 0,
+                "max_wait_ms": round(stats["max"] * 1000, 1),
+            }
+        return {
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "active_queues": len(self.queues),
+            "anonymous_queued": len(self.queues.get(ANONYMOUS_KEY, ())),
+            "wait_times": wait_times,
+        }
@@ -0,0 +1,193 @@
+import os
+import json
+import threading
+import logging
+from typing import List, Optional, Dict, Any
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+    logger.warning("numpy not installed - similarity index disabled. Run: pip install numpy")
+
+# Feature layout: 8x8 RGB thumbnail (layout), 8-bin histogram per channel (colour), aspect ratio
+THUMB_SIZE = 8
+HIST_BINS = 8
+FEATURE_DIM = THUMB_SIZE * THUMB_SIZE * 3 + HIST_BINS * 3 + 1
+
+
+def extract_features(image: Image.Image) -> Optional["np.ndarray"]:
+    """Compute a compact, L2-normalised colour/layout embedding for an image.
+
+    Pass a freshly opened image: JPEGs are then decoded at reduced scale
+    via draft(), which changes the image in place.
+    """
+    if not HAS_NUMPY:
+        return None
+
+    width, height = image.size
+    # Only effective before the image is loaded; lets the JPEG decoder downscale
+    image.draft('RGB', (THUMB_SIZE * 4, THUMB_SIZE * 4))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    thumb = image.resize((THUMB_SIZE, THUMB_SIZE), Image.BILINEAR)
+    pixels = np.asarray(thumb, dtype=np.float32).reshape(-1, 3) / 255.0
+
+    layout = (pixels - pixels.mean(axis=0)).ravel()
+    hist = np.concatenate([
+        np.histogram(pixels[:, channel], bins=HIST_BINS, range=(0.0, 1.0))[0]
+        for channel in range(3)
+    ]).astype(np.float32) / len(pixels)
+    aspect = np.array([np.log(width / max(height, 1))], dtype=np.float32)
+
+    vector = np.concatenate([layout, hist, aspect]).astype(np.float32)
+    norm = float(np.linalg.norm(vector))
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class CaptionSimilarityIndex:
+    """Append-only, memory-mapped k-NN index of image embeddings and their captions.
+
+    On-disk layout (all files grow by appending, so updates are incremental):
+      vectors.f32    - N x FEATURE_DIM float32 rows
+      offsets.u64    - N uint64 byte offsets into captions.jsonl
+      captions.jsonl - one JSON record per entry, read on demand
+    Loading only maps the two binary files, so startup cost does not depend on N.
+    """
+
+    def __init__(self, index_dir: str = "similarity_index", min_score: float = 0.9):
+        self.index_dir = index_dir
+        self.min_score = min_score
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.offsets_path = os.path.join(index_dir, "offsets.u64")
+        self.captions_path = os.path.join(index_dir, "captions.jsonl")
+        self.vectors = None
+        self.offsets = None
+        self.size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return HAS_NUMPY
+
+    def load(self):
+        """Map the index files into memory."""
+        if not HAS_NUMPY:
+            return
+        os.makedirs(self.index_dir, exist_ok=True)
+        with self._lock:
+            self._remap()
+        logger.info(f"Similarity index loaded: {self.size} entries")
+
+    def _remap(self):
+        """(Re)create the memory maps; entries are only visible once their vector row exists."""
+        vector_rows = self._file_size(self.vectors_path) // (FEATURE_DIM * 4)
+        offset_rows = self._file_size(self.offsets_path) // 8
+        self.size = min(vector_rows, offset_rows)
+
+        if self.size == 0:
+            self.vectors = np.empty((0, FEATURE_DIM), dtype=np.float32)
+            self.offsets = np.empty((0,), dtype=np.uint64)
+            return
+
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.size, FEATURE_DIM))
+        self.offsets = np.memmap(self.offsets_path, dtype=np.uint64, mode='r', shape=(self.size,))
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def add(self, features: Optional["np.ndarray"], captions: List[str], digest: Optional[str] = None):
+        """Append an embedding and the captions it received."""
+        if not HAS_NUMPY or features is None or not captions:
+            return
+
+        with self._lock:
+            if self.vectors is None:
+                os.makedirs(self.index_dir, exist_ok=True)
+                self._remap()
+
+            # Skip near-identical images (e.g. the same photo uploaded again)
+            if self.size and float(np.max(self.vectors @ features)) >= 0.999:
+                return
+
+            record = json.dumps({"digest": digest, "captions": captions}, ensure_ascii=False)
+            with open(self.captions_path, "ab") as f:
+                offset = f.tell()
+                f.write(record.encode("utf-8") + b"\n")
+
+            # Keep the files row-aligned before appending, in case a previous write was torn
+            self._truncate(self.offsets_path, self.size * 8)
+            self._truncate(self.vectors_path, self.size * FEATURE_DIM * 4)
+
+            with open(self.offsets_path, "ab") as f:
+                f.write(np.array([offset], dtype=np.uint64).tobytes())
+            # The vector row is written last and acts as the commit point
+            with open(self.vectors_path, "ab") as f:
+                f.write(features.astype(np.float32).tobytes())
+
+            self._remap()
+
+    def _truncate(self, path: str, size: int):
+        if self._file_size(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _read_record(self, row: int) -> Dict[str, Any]:
+        with open(self.captions_path, "rb") as f:
+            f.seek(int(self.offsets[row]))
+            return json.loads(f.readline())
+
+    def search(self, features: Optional["np.ndarray"], k: int = 5) -> List[Dict[str, Any]]:
+        """Return the k nearest entries by cosine similarity."""
+        if not HAS_NUMPY or features is None:
+            return []
+
+        with self._lock:
+            if not self.size:
+                return []
+            vectors = self.vectors
+            size = self.size
+
+        scores = vectors @ features
+        k = min(k, size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for row in top:
+            record = self._read_record(int(row))
+            record["score"] = float(scores[row])
+            results.append(record)
+        return results
+
+    def suggest_captions(self, features: Optional["np.ndarray"], count: int = 3, k: int = 5) -> Optional[List[str]]:
+        """Collect captions from sufficiently similar past images, best match first."""
+        captions = []
+        for result in self.search(features, k=k):
+            if result["score"] < self.min_score:
+                break
+            for caption in result["captions"]:
+                if caption not in captions:
+                    captions.append(caption)
+            if len(captions) >= count:
+                return captions[:count]
+        return captions or None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "entries": self.size,
+            "feature_dim": FEATURE_DIM,
+            "min_score": self.min_score,
+        }
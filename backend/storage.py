@@ -0,0 +1,448 @@
+import os
+import sys
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+def hash_shard(user_id: int, shard_count: int) -> int:
+    """Stable shard index for a user."""
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def shard_paths(shard_dir: str, shard_count: int) -> List[str]:
+    return [os.path.join(shard_dir, f"caption_maker_shard{index}.db") for index in range(shard_count)]
+
+
+class ShardedDatabase:
+    """Storage backend that spreads users' data over several SQLite files.
+
+    Users, sessions and two small directory tables live in the main database:
+      user_shards            - which shard holds each user's data
+      conversation_directory - globally unique conversation ids and their owner
+    Conversations, messages, saved captions, search indexes and version
+    counters live in the user's shard, so writes from different users mostly
+    land in different files and do not contend for one SQLite write lock.
+    The public methods mirror `Database`, so callers can use either backend.
+    """
+
+    def __init__(
+        self,
+        db_path: str = "caption_maker.db",
+        paths: Optional[List[str]] = None,
+        allow_legacy_data: bool = False,
+        **database_options
+    ):
+        if not paths:
+            raise ValueError("ShardedDatabase needs at least one shard path")
+
+        self.directory = Database(db_path)
+        self.init_directory()
+
+        # Data written before sharding was enabled would be invisible until moved
+        if not allow_legacy_data and self.has_legacy_data():
+            raise RuntimeError(
+                f"{db_path} still holds unsharded conversations or saved captions; "
+                f"run `python storage.py rebalance --shards {len(paths)}` before enabling STORAGE_SHARDS"
+            )
+
+        self.shards = []
+        for path in paths:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            shard = Database(path, **database_options)
+            shard.conversation_id_allocator = self.allocate_conversation_ids
+            self.shards.append(shard)
+
+        self._user_shards: Dict[int, int] = {}
+        self._conversation_owners: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def init_directory(self):
+        """Create the routing tables in the main database."""
+        conn = self.directory.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_shards (
+                user_id INTEGER PRIMARY KEY,
+                shard INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'conversation_directory'")
+        new_directory = cursor.fetchone() is None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_directory (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL
+            )
+        """)
+        if new_directory:
+            # Reserve ids of conversations still stored in the main database, so
+            # `rebalance` can move them into shards without id clashes
+            cursor.execute("INSERT INTO conversation_directory (id, user_id) SELECT id, user_id FROM conversations")
+
+        conn.commit()
+        conn.close()
+
+    def has_legacy_data(self) -> bool:
+        conn = self.directory.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM conversations) OR EXISTS (SELECT 1 FROM saved_captions)"
+        )
+        result = cursor.fetchone()[0]
+        conn.close()
+        return bool(result)
+
+    # ============ Routing ============
+
+    def shard_index(self, user_id: int) -> int:
+        """Shard recorded for a user, assigning one by hash on first use."""
+        with self._lock:
+            if user_id in self._user_shards:
+                return self._user_shards[user_id]
+
+        conn = self.directory.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR IGNORE INTO user_shards (user_id, shard) VALUES (?, ?)",
+            (user_id, hash_shard(user_id, len(self.shards)))
+        )
+        cursor.execute("SELECT shard FROM user_shards WHERE user_id = ?", (user_id,))
+        index = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+
+        if index >= len(self.shards):
+            raise RuntimeError(f"User {user_id} is on shard {index}, but only {len(self.shards)} shards are configured")
+
+        with self._lock:
+            self._user_shards[user_id] = index
+        return index
+
+    def shard_for_user(self, user_id: int) -> Database:
+        return self.shards[self.shard_index(user_id)]
+
+    def allocate_conversation_ids(self, user_id: int, count: int = 1) -> List[int]:
+        """Reserve `count` globally unique conversation ids for a user in one transaction."""
+        conn = self.directory.get_connection()
+        cursor = conn.cursor()
+        conversation_ids = []
+        for _ in range(count):
+            cursor.execute("INSERT INTO conversation_directory (user_id) VALUES (?)", (user_id,))
+            conversation_ids.append(cursor.lastrowid)
+        conn.commit()
+        conn.close()
+
+        with self._lock:
+            for conversation_id in conversation_ids:
+                self._conversation_owners[conversation_id] = user_id
+        return conversation_ids
+
+    def conversation_owner(self, conversation_id: int) -> Optional[int]:
+        with self._lock:
+            if conversation_id in self._conversation_owners:
+                return self._conversation_owners[conversation_id]
+
+        conn = self.directory.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM conversation_directory WHERE id = ?", (conversation_id,))
+        result = cursor.fetchone()
+        conn.close()
+
+        if not result:
+            return None
+        with self._lock:
+            # Ownership never changes, so the cache needs no invalidation
+            if len(self._conversation_owners) > 100000:
+                self._conversation_owners.clear()
+            self._conversation_owners[conversation_id] = result[0]
+        return result[0]
+
+    def shard_for_conversation(self, conversation_id: int) -> Optional[Database]:
+        user_id = self.conversation_owner(conversation_id)
+        if user_id is None:
+            return None
+        return self.shard_for_user(user_id)
+
+    # ============ Users and sessions (main database) ============
+
+    def hash_password(self, password: str) -> str:
+        return self.directory.hash_password(password)
+
+    def create_user(self, username: str, email: str, password: str) -> Optional[int]:
+        return self.directory.create_user(username, email, password)
+
+    def verify_user(self, username: str, password: str) -> Optional[Dict[str, Any]]:
+        return self.directory.verify_user(username, password)
+
+    def create_session(self, user_id: int) -> str:
+        return self.directory.create_session(user_id)
+
+    def verify_session(self, token: str) -> Optional[int]:
+        return self.directory.verify_session(token)
+
+    def delete_session(self, token: str):
+        self.directory.delete_session(token)
+
+    def get_user_info(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self.directory.get_user_info(user_id)
+
+    # ============ Per-user data (shards) ============
+
+    def create_conversation(self, user_id: int, title: str = "New Conversation") -> int:
+        return self.shard_for_user(user_id).create_conversation(user_id, title)
+
+    def get_user_conversations(self, user_id: int) -> List[Dict[str, Any]]:
+        return self.shard_for_user(user_id).get_user_conversations(user_id)
+
+    def add_message(
+        self,
+        conversation_id: int,
+        role: str,
+        content: str,
+        captions: Optional[List[str]] = None,
+        image_digest: Optional[str] = None
+    ) -> int:
+        return self.enqueue_message(conversation_id, role, content, captions, image_digest).result()
+
+    def enqueue_message(
+        self,
+        conversation_id: int,
+        role: str,
+        content: str,
+        captions: Optional[List[str]] = None,
+        image_digest: Optional[str] = None
+    ) -> Future:
+        shard = self.shard_for_conversation(conversation_id)
+        if shard is None:
+            raise ValueError(f"Unknown conversation {conversation_id}")
+        return shard.enqueue_message(conversation_id, role, content, captions, image_digest)
+
+    def get_conversation_messages(self, conversation_id: int) -> List[Dict[str, Any]]:
+        shard = self.shard_for_conversation(conversation_id)
+        if shard is None:
+            return []
+        return shard.get_conversation_messages(conversation_id)
+
+    def user_has_image(self, user_id: int, image_digest: str) -> bool:
+        return self.shard_for_user(user_id).user_has_image(user_id, image_digest)
+
+    def save_caption(self, user_id: int, caption: str) -> int:
+        return self.shard_for_user(user_id).save_caption(user_id, caption)
+
+    def get_saved_captions(self, user_id: int) -> List[Dict[str, Any]]:
+        return self.shard_for_user(user_id).get_saved_captions(user_id)
+
+    def delete_caption(self, caption_id: int, user_id: int) -> bool:
+        return self.shard_for_user(user_id).delete_caption(caption_id, user_id)
+
+    def search(self, user_id: int, query: str, **options) -> List[Dict[str, Any]]:
+        return self.shard_for_user(user_id).search(user_id, query, **options)
+
+    def export_user_data(self, user_id: int, batch_size: int = 500) -> Iterator[str]:
+        return self.shard_for_user(user_id).export_user_data(user_id, batch_size)
+
+    def import_records(self, user_id: int, records: List[Dict[str, Any]], conversation_ids: Dict[int, int]) -> Dict[str, int]:
+        return self.shard_for_user(user_id).import_records(user_id, records, conversation_ids)
+
+    def get_version(self, scope: str) -> int:
+        """Route a version scope ('<kind>:<id>') to the shard that owns it."""
+        kind, _, key = scope.partition(":")
+        if kind == "messages":
+            shard = self.shard_for_conversation(int(key))
+        else:
+            shard = self.shard_for_user(int(key))
+        return shard.get_version(scope) if shard else 0
+
+    # ============ Lifecycle ============
+
+    def flush_writes(self):
+        for shard in self.shards:
+            shard.flush_writes()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def write_stats(self) -> Optional[Dict[str, Any]]:
+        stats = {f"shard_{index}": shard.write_stats() for index, shard in enumerate(self.shards)}
+        if not any(stats.values()):
+            return None
+        return stats
+
+
+def move_user(user_id: int, source: Database, target: Database, batch_size: int = 1000) -> Dict[str, int]:
+    """Copy one user's data to another shard, then delete it from the source.
+
+    Conversation ids are kept (they are global); message and saved-caption
+    ids are reassigned by the target shard. Version counters are carried over
+    and bumped so clients revalidate instead of trusting old ETags.
+
+    The move can be re-run after an interruption: while the source still
+    holds the user's data, whatever an earlier attempt left in the target
+    is replaced.
+    """
+    source.flush_writes()
+    target.flush_writes()
+    src = source.get_connection()
+    dst = target.get_connection()
+    counts = {"conversations": 0, "messages": 0, "saved_captions": 0}
+
+    try:
+        src_cursor = src.cursor()
+        dst_cursor = dst.cursor()
+
+        src_cursor.execute(
+            """SELECT id, user_id, title, created_at, updated_at, message_count, last_caption, thumbnail_digest
+               FROM conversations WHERE user_id = ?""",
+            (user_id,)
+        )
+        conversations = [tuple(row) for row in src_cursor.fetchall()]
+        src_cursor.execute("SELECT 1 FROM saved_captions WHERE user_id = ? LIMIT 1", (user_id,))
+        if conversations or src_cursor.fetchone():
+            dst_cursor.execute(
+                "DELETE FROM messages WHERE conversation_id IN (SELECT id FROM conversations WHERE user_id = ?)",
+                (user_id,)
+            )
+            dst_cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+            dst_cursor.execute("DELETE FROM saved_captions WHERE user_id = ?", (user_id,))
+        dst_cursor.executemany(
+            """INSERT INTO conversations
+               (id, user_id, title, created_at, updated_at, message_count, last_caption, thumbnail_digest)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            conversations
+        )
+        counts["conversations"] = len(conversations)
+
+        src_cursor.execute(
+            """SELECT m.conversation_id, m.role, m.content, m.captions, m.image_digest, m.created_at
+               FROM messages m JOIN conversations c ON c.id = m.conversation_id
+               WHERE c.user_id = ? ORDER BY m.id""",
+            (user_id,)
+        )
+        for rows in iter(lambda: src_cursor.fetchmany(batch_size), []):
+            dst_cursor.executemany(
+                """INSERT INTO messages (conversation_id, role, content, captions, image_digest, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [tuple(row) for row in rows]
+            )
+            counts["messages"] += len(rows)
+
+        src_cursor.execute(
+            "SELECT user_id, caption, created_at FROM saved_captions WHERE user_id = ? ORDER BY id",
+            (user_id,)
+        )
+        for rows in iter(lambda: src_cursor.fetchmany(batch_size), []):
+            dst_cursor.executemany(
+                "INSERT INTO saved_captions (user_id, caption, created_at) VALUES (?, ?, ?)",
+                [tuple(row) for row in rows]
+            )
+            counts["saved_captions"] += len(rows)
+
+        scopes = [f"conversations:{user_id}", f"saved:{user_id}"] + [f"messages:{row[0]}" for row in conversations]
+        placeholders = ", ".join("?" * len(scopes))
+        src_cursor.execute(f"SELECT scope, version FROM resource_versions WHERE scope IN ({placeholders})", scopes)
+        versions = {row[0]: row[1] for row in src_cursor.fetchall()}
+        dst_cursor.executemany(
+            """INSERT INTO resource_versions (scope, version) VALUES (?, ?)
+               ON CONFLICT(scope) DO UPDATE SET version = MAX(version, excluded.version)""",
+            [(scope, versions.get(scope, 0) + 1) for scope in scopes]
+        )
+        dst.commit()
+
+        src_cursor.execute(
+            "DELETE FROM messages WHERE conversation_id IN (SELECT id FROM conversations WHERE user_id = ?)",
+            (user_id,)
+        )
+        src_cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+        src_cursor.execute("DELETE FROM saved_captions WHERE user_id = ?", (user_id,))
+        src.commit()
+    finally:
+        src.close()
+        dst.close()
+
+    return counts
+
+
+def rebalance(db_path: str, shard_dir: str, shard_count: int) -> Dict[str, int]:
+    """Move every user whose hash shard differs under `shard_count`.
+
+    Data still kept in the main database (from before sharding was enabled)
+    is moved into shards as well. Run it while the service is stopped, then
+    start the service with STORAGE_SHARDS set to the new count. Shard files
+    beyond the new count are drained but left on disk. An interrupted run
+    can simply be repeated.
+
+    `shard_count` must be at least 2: with STORAGE_SHARDS=1 the service
+    reads only the main database, never a shard.
+    """
+    if shard_count < 2:
+        raise ValueError("shard_count must be at least 2")
+    existing = len([name for name in os.listdir(shard_dir) if name.endswith(".db")]) if os.path.isdir(shard_dir) else 0
+    storage = ShardedDatabase(db_path, shard_paths(shard_dir, max(shard_count, existing)), allow_legacy_data=True)
+    totals = {"users": 0, "conversations": 0, "messages": 0, "saved_captions": 0}
+
+    def record_move(user_id: int, source: Database, wanted: int, label: str):
+        counts = move_user(user_id, source, storage.shards[wanted])
+        conn = storage.directory.get_connection()
+        conn.execute("INSERT OR REPLACE INTO user_shards (user_id, shard) VALUES (?, ?)", (user_id, wanted))
+        conn.commit()
+        conn.close()
+        storage._user_shards[user_id] = wanted
+
+        totals["users"] += 1
+        for key, value in counts.items():
+            totals[key] += value
+        logger.info(f"Moved user {user_id} from {label} to shard {wanted}: {counts}")
+
+    conn = storage.directory.get_connection()
+    legacy_users = [row[0] for row in conn.execute(
+        "SELECT user_id FROM conversations UNION SELECT user_id FROM saved_captions"
+    ).fetchall()]
+    assignments = [tuple(row) for row in conn.execute("SELECT user_id, shard FROM user_shards").fetchall()]
+    conn.close()
+
+    for user_id, current in assignments:
+        wanted = hash_shard(user_id, shard_count)
+        if wanted != current:
+            record_move(user_id, storage.shards[current], wanted, f"shard {current}")
+
+    for user_id in legacy_users:
+        record_move(user_id, storage.directory, hash_shard(user_id, shard_count), "main database")
+
+    return totals
+
+
+def create_storage(db_path: str = "caption_maker.db", **database_options):
+    """Build the storage backend selected by STORAGE_SHARDS / STORAGE_SHARD_DIR."""
+    shard_count = int(os.environ.get("STORAGE_SHARDS", "1"))
+    if shard_count <= 1:
+        return Database(db_path, **database_options)
+
+    shard_dir = os.environ.get("STORAGE_SHARD_DIR", "shards")
+    logger.info(f"Using {shard_count} SQLite shards in {shard_dir}")
+    return ShardedDatabase(db_path, shard_paths(shard_dir, shard_count), **database_options)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sharded storage maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebalance_parser = subparsers.add_parser("rebalance", help="Move users to their shard for a new shard count")
+    rebalance_parser.add_argument("--shards", type=int, required=True)
+    rebalance_parser.add_argument("--shard-dir", default=os.environ.get("STORAGE_SHARD_DIR", "shards"))
+    rebalance_parser.add_argument("--db", default="caption_maker.db")
+    args = parser.parse_args()
+
+    if args.shards < 2:
+        sys.exit("--shards must be at least 2; STORAGE_SHARDS=1 reads only the main database, not shards")
+    print(rebalance(args.db, args.shard_dir, args.shards))
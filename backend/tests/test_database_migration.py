@@ -0,0 +1,99 @@
+import os
+import sys
+import sqlite3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+# Schema of databases created before summaries, image digests and search existed
+BASELINE_SCHEMA = """
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        token TEXT UNIQUE NOT NULL,
+        expires_at TIMESTAMP NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    );
+    CREATE TABLE conversations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        title TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    );
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        captions TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+    );
+    CREATE TABLE saved_captions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        caption TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    );
+"""
+
+
+def make_baseline_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (username, email, password_hash) VALUES ('ann', 'ann@example.com', 'x')")
+    conn.execute("INSERT INTO conversations (user_id, title) VALUES (1, 'Beach')")
+    conn.execute(
+        "INSERT INTO messages (conversation_id, role, content, captions) VALUES (1, 'assistant', 'Generated captions', ?)",
+        ('["Golden hour 🌅", "Salt in the air"]',)
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_opens_baseline_schema(tmp_path):
+    path = str(tmp_path / "caption_maker.db")
+    make_baseline_db(path)
+
+    db = Database(path)
+
+    conversation = db.get_user_conversations(1)[0]
+    assert conversation["message_count"] == 1
+    assert conversation["last_caption"] == "Golden hour 🌅"
+    assert db.get_conversation_messages(1)[0]["captions"] == ["Golden hour 🌅", "Salt in the air"]
+    assert [result["text"] for result in db.search(1, "golden")] == ["Golden hour 🌅"]
+
+
+def test_failed_upgrade_is_retried(tmp_path, monkeypatch):
+    path = str(tmp_path / "caption_maker.db")
+    make_baseline_db(path)
+
+    def fail(self, cursor):
+        raise sqlite3.OperationalError("simulated failure")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(Database, "init_search_index", fail)
+        try:
+            Database(path)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError("expected the first start to fail")
+
+    db = Database(path)
+
+    conversation = db.get_user_conversations(1)[0]
+    assert conversation["message_count"] == 1
+    assert conversation["last_caption"] == "Golden hour 🌅"
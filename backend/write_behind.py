@@ -0,0 +1,173 @@
+import time
+import atexit
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Collects writes and flushes them in batches from a background thread.
+
+    `flush_fn` receives a list of queued items, writes them in a single
+    transaction and returns one result per item (e.g. the new row ids).
+    Callers get a Future per item; `flush()` can also be called directly as a
+    read barrier so a reader always sees its own earlier writes.
+
+    `flush_fn` must roll back on failure, so a failed batch can be retried
+    as a whole. After `max_retries` failed attempts (with doubling delays)
+    the items are written one by one, and only those that still fail have
+    their Futures set to the exception.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[List[Any]], List[Any]],
+        flush_interval: float = 0.05,
+        max_batch: int = 256,
+        name: str = "write-behind",
+        max_retries: int = 3,
+        retry_delay: float = 0.05
+    ):
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.name = name
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self._pending: List[Tuple[Any, Future]] = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+
+        # Metrics
+        self.batches = 0
+        self.items = 0
+        self.max_batch_size = 0
+        self.last_batch_size = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+        self.retries = 0
+        self.failed_batches = 0
+        self.failed_items = 0
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, item: Any) -> Future:
+        """Queue an item for the next batch."""
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"{self.name} queue is closed")
+            self._pending.append((item, future))
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    @property
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+                # Give concurrent writers a short window to join this batch
+                if not self._closed and len(self._pending) < self.max_batch:
+                    self._cond.wait(timeout=self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write everything queued so far; returns once it is committed."""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+
+            for start in range(0, len(batch), self.max_batch):
+                self._flush_batch(batch[start:start + self.max_batch])
+
+    def _write_with_retries(self, items: List[Any]) -> List[Any]:
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.flush_fn(items)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"{self.name} flush of {len(items)} items failed, retrying in {delay:.2f}s: {e}")
+                self.retries += 1
+                time.sleep(delay)
+                delay *= 2
+
+    def _flush_batch(self, batch: List[Tuple[Any, Future]]):
+        started = time.perf_counter()
+        try:
+            results = self._write_with_retries([item for item, _ in batch])
+        except Exception as e:
+            logger.error(f"{self.name} flush of {len(batch)} items failed: {e}")
+            self.failed_batches += 1
+            self._flush_individually(batch, e)
+            return
+        elapsed = time.perf_counter() - started
+
+        self.batches += 1
+        self.items += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.last_flush_time = elapsed
+        self.total_flush_time += elapsed
+        self.max_flush_time = max(self.max_flush_time, elapsed)
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _flush_individually(self, batch: List[Tuple[Any, Future]], error: Exception):
+        """Write the items of a failed batch one at a time, failing only those that still fail."""
+        for item, future in batch:
+            if len(batch) > 1:
+                try:
+                    future.set_result(self.flush_fn([item])[0])
+                    continue
+                except Exception as e:
+                    error = e
+            logger.error(f"{self.name} dropped an item: {error}")
+            self.failed_items += 1
+            future.set_exception(error)
+
+    def close(self):
+        """Stop the background thread and flush anything still queued."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+        logger.info(f"{self.name} queue closed after {self.batches} batches / {self.items} items")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending,
+            "batches": self.batches,
+            "items": self.items,
+            "retries": self.retries,
+            "failed_batches": self.failed_batches,
+            "failed_items": self.failed_items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_flush_ms": round(self.total_flush_time / self.batches * 1000, 3) if self.batches else 0,
+            "last_flush_ms": round(self.last_flush_time * 1000, 3),
+            "max_flush_ms": round(self.max_flush_time * 1000, 3),
+            "flush_interval_ms": self.flush_interval * 1000,
+        }